@@ -0,0 +1,324 @@
+#! /usr/bin/python
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+from collections import defaultdict
+from StringIO import StringIO
+from optparse import OptionParser
+
+import count_freqs
+from hmm import Hmm, simple_conll_corpus_iterator, write_tagged
+from corpus import Corpus
+from eval_gene_tagger import Evaluator, corpus_iterator
+
+"""
+Benchmarks for the tagging pipeline: counting (count_freqs.Hmm.train),
+reading counts (Hmm.read_counts), decoding (predict_p1, predict_p3 and
+the compiled decoder behind Hmm.decode) and scoring
+(eval_gene_tagger.Evaluator.compare).
+
+Every stage is run on the bundled gene.train / gene.key data (scale 1)
+and on synthetic corpora scale times as large. Results are written as
+JSON: per scale and stage the wall time per call of every run and of
+the fastest, the number of tokens (lines for read_counts), tokens per
+second of the fastest run and the peak RSS while the stage ran once
+(the peak is reset through /proc/self/clear_refs before the stage; null
+where the kernel cannot do that). Every stage is run --repeat times.
+Given a baseline file written by an earlier run, a stage is reported as
+a regression, and the exit status is 1, if even its fastest run is
+slower than the slowest baseline run by more than the tolerance: the
+spread of the baseline runs measures how noisy the machine is.
+
+    python benchmark.py -o baseline.json
+    python benchmark.py --baseline baseline.json --scales 1,10
+"""
+
+STAGES = ["train", "read_counts", "predict_p1", "predict_p3", "decode", "evaluate"]
+
+
+def read_sentences(corpus_file):
+    """
+    Tagged sentences of a corpus file as lists of (word, tag) pairs.
+    """
+    return list(Corpus.load(corpus_file).tagged_sentences())
+
+
+def synthetic_corpus(sentences, scale, output, seed=0):
+    """
+    Write scale * len(sentences) sentences drawn with replacement from
+    sentences to output. Words seen once in sentences get a new spelling
+    in each of the scale copies, so the vocabulary grows with the corpus
+    as it does in real text. Returns the number of tokens written.
+    """
+    rng = random.Random(seed)
+    counts = defaultdict(int)
+    for sentence in sentences:
+        for word, tag in sentence:
+            counts[word] += 1
+    tokens = 0
+    for copy in xrange(scale):
+        for i in xrange(len(sentences)):
+            for word, tag in sentences[rng.randrange(len(sentences))]:
+                if copy and counts[word] == 1:
+                    word = "%s~%i" % (word, copy)
+                output.write("%s %s\n" % (word, tag))
+                tokens += 1
+            output.write("\n")
+    return tokens
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in kB (Linux units).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    """
+    Start the peak RSS over from the current RSS (Linux 4.0 and later).
+    Returns False where that is not possible.
+    """
+    try:
+        clear_refs = open("/proc/self/clear_refs", "w")
+        try:
+            clear_refs.write("5")
+        finally:
+            clear_refs.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def timed(number, function, *args):
+    """
+    (seconds per call, value of the last call) of number calls, with the
+    garbage collector off as in timeit, so that collections triggered by
+    earlier stages do not land in them.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        for i in xrange(number):
+            value = function(*args)
+        return (time.time() - start) / number, value
+    finally:
+        gc.enable()
+
+
+class StageTimer(object):
+    """
+    Collects the results of the stages of one scale.
+    """
+
+    # A timed run calls a stage often enough to last this long (seconds)
+    min_time = 0.2
+
+    def __init__(self, stages, repeat=5):
+        self.stages = stages
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name, items, function, *args):
+        """
+        Time function(*args) in repeat runs and record the fastest. Like
+        timeit, a run calls a stage that is faster than min_time several
+        times and takes the mean. The peak RSS is that of the first call.
+        function must start from the same state every time. Returns the
+        value of the last call.
+        """
+        if name not in self.stages:
+            return None
+        gc.collect()
+        reset = reset_peak_rss()
+        first, value = timed(1, function, *args)
+        rss = reset and peak_rss() or None
+        number = max(1, int(self.min_time / max(first, 1e-9)) + 1)
+        runs = []
+        for i in xrange(self.repeat):
+            seconds, value = timed(number, function, *args)
+            runs.append(seconds)
+        seconds = min(runs)
+        self.results[name] = {
+            "seconds": seconds,
+            "runs": runs,
+            "calls_per_run": number,
+            "items": items,
+            "unit": name == "read_counts" and "lines" or "tokens",
+            "per_second": items / max(seconds, 1e-9),
+            "peak_rss_kb": rss,
+        }
+        return value
+
+
+def train_counts(train_name):
+    counter = count_freqs.Hmm(3)
+    counter.train(open(train_name))
+    return counter
+
+def read_counts(hmm, counts_name):
+    hmm.read_counts(open(counts_name))
+
+def tag_all(predict, sentences):
+    return [predict(sentence) for sentence in sentences]
+
+def decode(hmm, sentences):
+    # compiling the tables is part of the cost of the fast decoder
+    hmm.reset_tables()
+    return hmm.decode(sentences)
+
+def evaluate(key_name, sentences, tags):
+    output = StringIO()
+    write_tagged(output, zip(sentences, tags))
+    output.seek(0)
+    evaluator = Evaluator()
+    evaluator.compare(corpus_iterator(open(key_name)), corpus_iterator(output))
+    counts = evaluator.class_counts["GENE"]
+    if counts.tp == 0:
+        return 0.0
+    return 2.0 * counts.tp / (2 * counts.tp + counts.fp + counts.fn)
+
+
+def benchmark_scale(train_name, key_name, workdir, stages, repeat=5):
+    """
+    Run the stages on one training corpus and one tagged test corpus.
+    """
+    timer = StageTimer(stages, repeat)
+    train_tokens = sum(1 for word, tag in simple_conll_corpus_iterator(open(train_name)) if word is not None)
+
+    counter = timer.run("train", train_tokens, train_counts, train_name) or train_counts(train_name)
+    counts_name = os.path.join(workdir, "counts.out")
+    counts_file = open(counts_name, "w")
+    counter.write_counts(counts_file)
+    counts_file.close()
+    del counter
+
+    hmm = Hmm(3)
+    lines = sum(1 for line in open(counts_name))
+    timer.run("read_counts", lines, read_counts, hmm, counts_name)
+    if "read_counts" not in stages:
+        read_counts(hmm, counts_name)
+    hmm.replace_rare()
+
+    sentences = [[word for word, tag in sentence] for sentence in read_sentences(open(key_name))]
+    test_tokens = sum([len(s) for s in sentences])
+    tags = None
+    for name, predict in (("predict_p1", hmm.predict_p1), ("predict_p3", hmm.predict_p3)):
+        tags = timer.run(name, test_tokens, tag_all, predict, sentences) or tags
+    tags = timer.run("decode", test_tokens, decode, hmm, sentences) or tags
+    if tags is None:
+        tags = hmm.decode(sentences)
+    f1 = timer.run("evaluate", test_tokens, evaluate, key_name, sentences, tags)
+
+    return {
+        "train_tokens": train_tokens,
+        "test_tokens": test_tokens,
+        "f1": f1,
+        "stages": timer.results,
+    }
+
+
+def run_benchmarks(train_name, key_name, scales, stages, seed=0, repeat=5):
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scales": {},
+    }
+    workdir = tempfile.mkdtemp(prefix="hmm-benchmark-")
+    try:
+        train_sentences = None
+        for scale in scales:
+            if scale == 1:
+                scale_train, scale_key = train_name, key_name
+            else:
+                if train_sentences is None:
+                    train_sentences = read_sentences(open(train_name))
+                    key_sentences = read_sentences(open(key_name))
+                scale_train = os.path.join(workdir, "train.%i" % scale)
+                scale_key = os.path.join(workdir, "key.%i" % scale)
+                for sentences, name in ((train_sentences, scale_train), (key_sentences, scale_key)):
+                    output = open(name, "w")
+                    synthetic_corpus(sentences, scale, output, seed)
+                    output.close()
+            sys.stderr.write("scale %i...\n" % scale)
+            results["scales"][str(scale)] = benchmark_scale(scale_train, scale_key, workdir, stages, repeat)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def compare_baseline(results, baseline, tolerance=0.35):
+    """
+    Stages whose fastest run is slower than the slowest run of the
+    baseline by more than tolerance (a fraction of its throughput), as
+    (scale, stage, baseline, current) tuples of throughputs. A stage that
+    varied a lot between the baseline runs must get slower by as much
+    again before it counts.
+    """
+    regressions = []
+    for scale, result in sorted(results["scales"].iteritems()):
+        old_stages = baseline.get("scales", {}).get(scale, {}).get("stages", {})
+        for stage, timing in sorted(result["stages"].iteritems()):
+            if stage not in old_stages:
+                continue
+            old_timing = old_stages[stage]
+            # files written before repeated runs only have the one time
+            slowest = max(old_timing.get("runs") or [old_timing["seconds"]])
+            old = old_timing["items"] / max(slowest, 1e-9)
+            if timing["per_second"] < (1 - tolerance) * old:
+                regressions.append((scale, stage, old, timing["per_second"]))
+    return regressions
+
+
+def usage():
+    return """
+    python benchmark.py [options]
+        Time the stages of the tagger on gene.train / gene.key and on
+        synthetic corpora scaled from them, and write the results as JSON."""
+
+if __name__ == "__main__":
+
+    parser = OptionParser(usage=usage())
+    parser.add_option("--train", default="gene.train", help="tagged training corpus")
+    parser.add_option("--key", default="gene.key", help="tagged test corpus")
+    parser.add_option("--scales", default="1",
+                      help="comma separated corpus sizes relative to the bundled data, e.g. 1,10,100,1000")
+    parser.add_option("--stages", default=",".join(STAGES),
+                      help="comma separated stages to time (default %s)" % ",".join(STAGES))
+    parser.add_option("--seed", type="int", default=0, help="seed for the synthetic corpora")
+    parser.add_option("-r", "--repeat", type="int", default=5,
+                      help="runs of every stage; the fastest is compared (default 5)")
+    parser.add_option("-o", "--output", help="write the JSON results to this file instead of stdout")
+    parser.add_option("-b", "--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_option("--tolerance", type="float", default=0.35,
+                      help="allowed drop in throughput against the slowest baseline run (default 0.35)")
+    options, args = parser.parse_args()
+
+    stages = options.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("unknown stage %s" % stage)
+    scales = [int(scale) for scale in options.scales.split(",")]
+
+    if options.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    results = run_benchmarks(options.train, options.key, scales, stages, options.seed, options.repeat)
+    output = options.output and open(options.output, "w") or sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write("\n")
+
+    if options.baseline:
+        regressions = compare_baseline(results, json.load(open(options.baseline)), options.tolerance)
+        for scale, stage, old, new in regressions:
+            sys.stderr.write("Regression at scale %s in %s: %.0f/s, slowest baseline run %.0f/s\n" % (scale, stage, new, old))
+        if regressions:
+            sys.exit(1)
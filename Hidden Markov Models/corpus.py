@@ -0,0 +1,223 @@
+#! /usr/bin/python
+
+from array import array
+from itertools import compress, count, groupby, imap, izip, repeat
+from operator import add, mul, not_, sub
+
+"""
+Load a corpus file (one token per line, a blank line after every
+sentence) in one go into columns instead of yielding a tuple per token:
+
+    vocab    list of the distinct words, sorted; a word id indexes it
+    tagset   list of the distinct tags, sorted (empty if untagged)
+    words    array of the word id of every token, in order
+    tags     array of the tag id of every token (empty if untagged)
+    offsets  array: sentence i is tokens offsets[i]:offsets[i+1]
+
+The word ids are only computed when vocab or words is first used; the
+decoder and the evaluator work on the words themselves (word_list()).
+
+A tagged line is "word tag" (the word may contain spaces), an untagged
+line is the word. Every blank line ends a sentence, so blank lines in a
+row make empty sentences; they are kept for stream(), which gives back
+the file token by token, and skipped by sentences().
+
+Training (hmm.py, count_freqs.py), decoding and evaluation
+(eval_gene_tagger.py) read their files through this module.
+"""
+
+class CorpusError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class Corpus(object):
+
+    def __init__(self, word_list, tagset, tags, offsets, terminated=True, line_tags=None):
+        self.tagged = line_tags is not None
+        self.line_tags = line_tags # tag of every line of the file, "" if blank
+        self._word_list = word_list
+        self._vocab = None
+        self._words = None
+        self.tagset = tagset
+        self.tags = tags
+        self.offsets = offsets
+        self.terminated = terminated # the last sentence has a blank line after it
+
+    @classmethod
+    def load(cls, corpus_file, tagged=True, with_logprob=False):
+        """
+        Read a whole corpus file. With with_logprob set every tagged line
+        ends in a log probability after the tag, which is dropped.
+        """
+        lines = corpus_file.read().split("\n")
+        if lines and not lines[-1]:
+            lines.pop() # the newline at the end of the last line
+        column = [] # the tag (or the word if untagged) of every line, "" if blank
+        words = []
+        add = column.append
+        add_word = words.append
+        for line in lines:
+            line = line.strip()
+            if not line:
+                add("")
+            elif tagged:
+                word, space, tag = line.rpartition(" ")
+                if with_logprob:
+                    if not space:
+                        raise CorpusError(line)
+                    word, space, tag = word.rpartition(" ")
+                add_word(word)
+                add(tag)
+            else:
+                add(line)
+
+        # the k-th blank line ends a sentence after line - k tokens
+        blanks = list(compress(count(), imap(not_, column)))
+        offsets = array('i', [0])
+        offsets.extend(imap(sub, blanks, count()))
+        terminated = not column or not column[-1]
+        if not terminated:
+            offsets.append(len(column) - len(blanks))
+        if tagged:
+            tagset, tags = _index(filter(None, column))
+            return cls(words, tagset, tags, offsets, terminated, column)
+        return cls(filter(None, column), [], array('i'), offsets, terminated)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def vocab(self):
+        if self._vocab is None:
+            self._vocab, self._words = _index(self._word_list)
+        return self._vocab
+
+    @property
+    def words(self):
+        if self._words is None:
+            self._vocab, self._words = _index(self._word_list)
+        return self._words
+
+    def spans(self):
+        """
+        (start, end) token offsets of the sentences that are not empty.
+        """
+        offsets = self.offsets
+        return [(offsets[i], offsets[i+1]) for i in xrange(len(offsets) - 1)
+                if offsets[i] < offsets[i+1]]
+
+    def word_list(self):
+        """
+        The words of all tokens (not a copy).
+        """
+        return self._word_list
+
+    def tag_list(self):
+        return map(self.tagset.__getitem__, self.tags)
+
+    def sentences(self):
+        """
+        Yield the sentences that are not empty as lists of words.
+        """
+        words = self.word_list()
+        for start, end in self.spans():
+            yield words[start:end]
+
+    def tagged_sentences(self):
+        """
+        Yield the sentences that are not empty as lists of (word, tag)
+        tuples, like hmm.sentence_iterator.
+        """
+        words = self.word_list()
+        tags = self.tag_list()
+        for start, end in self.spans():
+            yield zip(words[start:end], tags[start:end])
+
+    def stream(self):
+        """
+        The words and the tags (None if untagged) of the file line by line,
+        with None for every blank line, as eval_gene_tagger.corpus_iterator
+        yields them.
+        """
+        words = self.word_list()
+        offsets = self.offsets
+        stream = []
+        for i in xrange(len(offsets) - 1):
+            stream.extend(words[offsets[i]:offsets[i+1]])
+            stream.append(None)
+        if not self.terminated:
+            stream.pop()
+        if not self.tagged:
+            return stream, None
+        return stream, map({"": None}.get, self.line_tags, self.line_tags)
+
+
+def _index(items):
+    """
+    The sorted distinct items and an array of the index of every item.
+    """
+    distinct = sorted(set(items))
+    index = dict(izip(distinct, count()))
+    return distinct, array('i', map(index.__getitem__, items))
+
+
+def count_keys(keys):
+    """
+    (key, occurrences) of every distinct key, by sorting.
+    """
+    return [(key, len(list(run))) for key, run in groupby(sorted(keys))]
+
+
+def count_ngrams(corpus, n):
+    """
+    Emission counts {(word, tag): count} and tag n-gram counts [{(tag,):
+    count}, {(tag, tag): count}, ...] of a tagged corpus, the same as
+    counting the n-grams of every sentence padded with n-1 '*' and one
+    'STOP' (hmm.get_ngrams). Every count is computed on integer keys with
+    one sort over the corpus, not per token.
+    """
+    vocab = corpus.vocab
+    tagset = corpus.tagset
+    T = len(tagset)
+    emission_counts = {}
+    for key, c in count_keys(imap(add, imap(mul, corpus.words, repeat(T)), corpus.tags)):
+        emission_counts[(vocab[key // T], tagset[key % T])] = c
+
+    # All sentences in one sequence of tag ids padded as by get_ngrams, and
+    # the positions an n-gram can end at: every tag and every STOP
+    symbols = tagset + ["*", "STOP"]
+    B = len(symbols)
+    padding = array('i', [T] * (n - 1))
+    sequence = array('i')
+    ends = array('i')
+    spans = corpus.spans()
+    for start, end in spans:
+        base = len(sequence)
+        sequence.extend(padding)
+        sequence.extend(corpus.tags[start:end])
+        sequence.append(T + 1)
+        ends.extend(xrange(base + n - 1, len(sequence)))
+
+    ngram_counts = [{} for i in xrange(n)]
+    for key, c in count_keys(corpus.tags):
+        ngram_counts[0][(tagset[key],)] = c
+    # key of the k-gram ending at e: sum of sequence[e - j] * B^j for j < k
+    keys = map(sequence.__getitem__, ends)
+    for k in xrange(2, n + 1):
+        history = imap(sequence.__getitem__, imap(sub, ends, repeat(k - 1)))
+        keys = map(add, keys, imap(mul, history, repeat(B ** (k - 1))))
+        for key, c in count_keys(keys):
+            ngram = []
+            for j in xrange(k):
+                key, symbol = divmod(key, B)
+                ngram.append(symbols[symbol])
+            ngram.reverse()
+            ngram_counts[k-1][tuple(ngram)] = c
+    if spans:
+        stars = tuple((n - 1) * ["*"])
+        ngram_counts[n-2][stars] = ngram_counts[n-2].get(stars, 0) + len(spans)
+    return emission_counts, ngram_counts
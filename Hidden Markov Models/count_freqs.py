@@ -4,8 +4,12 @@ __author__="Daniel Bauer <bauer@cs.columbia.edu>"
 __date__ ="$Sep 12, 2011"
 
 import sys
+import os
 from collections import defaultdict
+from StringIO import StringIO
+from multiprocessing import Pool
 import math
+from corpus import Corpus, count_ngrams
 
 """
 Count n-gram frequencies in a data file and write counts to
@@ -74,6 +78,42 @@ def get_ngrams(sent_iterator, n):
             yield n_gram        
 
 
+def corpus_shards(corpus_name, shard_bytes):
+    """
+    Split a corpus file into (start, end) byte ranges of roughly
+    shard_bytes each. Every range ends right after a blank line, so
+    shards hold whole sentences.
+    """
+    size = os.path.getsize(corpus_name)
+    corpus_file = open(corpus_name, "r")
+    offsets = [0]
+    while size - offsets[-1] > shard_bytes:
+        corpus_file.seek(offsets[-1] + shard_bytes)
+        corpus_file.readline() # Skip the rest of the current line
+        l = corpus_file.readline()
+        while l and l.strip(): # and move on to the end of the sentence
+            l = corpus_file.readline()
+        if corpus_file.tell() >= size:
+            break
+        offsets.append(corpus_file.tell())
+    corpus_file.close()
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+def count_shard(args):
+    """
+    Worker for Hmm.train_parallel: count one shard of the corpus and
+    return the counts as plain dicts.
+    """
+    corpus_name, start, end, n = args
+    corpus_file = open(corpus_name, "r")
+    corpus_file.seek(start)
+    counter = Hmm(n)
+    counter.train(StringIO(corpus_file.read(end - start)))
+    corpus_file.close()
+    return dict(counter.emission_counts), [dict(counts) for counts in counter.ngram_counts]
+
+
 class Hmm(object):
     """
     Stores counts for n-grams and emissions. 
@@ -90,24 +130,35 @@ class Hmm(object):
         """
         Count n-gram frequencies and emission probabilities from a corpus file.
         """
-        ngram_iterator = \
-            get_ngrams(sentence_iterator(simple_conll_corpus_iterator(corpus_file)), self.n)
+        self.merge(*count_ngrams(Corpus.load(corpus_file), self.n))
 
-        for ngram in ngram_iterator:
-            #Sanity check: n-gram we get from the corpus stream needs to have the right length
-            assert len(ngram) == self.n, "ngram in stream is %i, expected %i" % (len(ngram, self.n))
-
-            tagsonly = tuple([ne_tag for word, ne_tag in ngram]) #retrieve only the tags            
-            for i in xrange(2, self.n+1): #Count NE-tag 2-grams..n-grams
-                self.ngram_counts[i-1][tagsonly[-i:]] += 1
-            
-            if ngram[-1][0] is not None: # If this is not the last word in a sentence
-                self.ngram_counts[0][tagsonly[-1:]] += 1 # count 1-gram
-                self.emission_counts[ngram[-1]] += 1 # and emission frequencies
-
-            # Need to count a single n-1-gram of sentence start symbols per sentence
-            if ngram[-2][0] is None: # this is the first n-gram in a sentence
-                self.ngram_counts[self.n - 2][tuple((self.n - 1) * ["*"])] += 1
+    def train_parallel(self, corpus_name, processes=None, shard_bytes=1 << 26):
+        """
+        Same counts as train, but the corpus file is cut into shards on
+        sentence boundaries and every shard is counted by a worker
+        process. Workers read their own byte range of the file, so the
+        parent never holds more than the merged counts.
+        """
+        shards = [(corpus_name, start, end, self.n)
+                  for start, end in corpus_shards(corpus_name, shard_bytes)]
+        pool = Pool(processes)
+        try:
+            for emission_counts, ngram_counts in pool.imap_unordered(count_shard, shards):
+                self.merge(emission_counts, ngram_counts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def merge(self, emission_counts, ngram_counts):
+        """
+        Add counts from another counter (e.g. one shard of the corpus).
+        Counts are sums, so merging in any order gives the same result.
+        """
+        for key, count in emission_counts.iteritems():
+            self.emission_counts[key] += count
+        for i in xrange(self.n):
+            for ngram, count in ngram_counts[i].iteritems():
+                self.ngram_counts[i][ngram] += count
 
     def write_counts(self, output, printngrams=[1,2,3]):
         """
@@ -150,15 +201,17 @@ class Hmm(object):
 
 def usage():
     print """
-    python count_freqs.py [input_file] > [output_file]
+    python count_freqs.py [input_file] [processes] > [output_file]
         Read in a gene tagged training input file and produce counts.
+        With processes > 1 the file is counted in parallel shards.
     """
 
 if __name__ == "__main__":
 
-    if len(sys.argv)!=2: # Expect exactly one argument: the training data file
+    if len(sys.argv) not in (2, 3): # Expect the training data file and optionally a process count
         usage()
         sys.exit(2)
+    processes = len(sys.argv) == 3 and int(sys.argv[2]) or 1
 
     try:
         input = file(sys.argv[1],"r")
@@ -169,6 +222,10 @@ if __name__ == "__main__":
     # Initialize a trigram counter
     counter = Hmm(3)
     # Collect counts
-    counter.train(input)
+    if processes > 1:
+        input.close()
+        counter.train_parallel(sys.argv[1], processes)
+    else:
+        counter.train(input)
     # Write the counts
     counter.write_counts(sys.stdout)
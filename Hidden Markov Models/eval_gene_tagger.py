@@ -4,6 +4,12 @@ __author__="Daniel Bauer <bauer@cs.columbia.edu>"
 __date__ ="$Sep 29, 2011"
 
 import sys
+import re
+from array import array
+from bisect import bisect
+from itertools import groupby, imap, islice
+
+from corpus import Corpus, CorpusError
 
 
 """
@@ -55,6 +61,204 @@ def corpus_iterator(corpus_file, with_logprob = False):
         sys.exit(1)
 
 
+def read_tagged(corpus_file, with_logprob = False):
+    """
+    Read a whole tagged file into a list of words and a list of tags, with
+    None for both at sentence boundaries, as corpus_iterator yields them.
+    """
+    return load_tagged(corpus_file, with_logprob).stream()
+
+def load_tagged(corpus_file, with_logprob = False):
+    """
+    Read a whole tagged file into a corpus.Corpus.
+    """
+    try:
+        return Corpus.load(corpus_file, with_logprob=with_logprob)
+    except CorpusError, e:
+        sys.stderr.write("Could not read line: \n")
+        sys.stderr.write("\n%s" % e.value)
+        sys.stderr.write("Did you forget to output log probabilities in the prediction file?\n")
+        sys.exit(1)
+
+
+# Kinds of tags: what a tag does to the entity the stream is in
+ENDS, BEGINS, INSIDE, OTHER = range(4)
+
+class TagIndex(object):
+    """
+    Maps tag strings to integer ids, and ids to the kind of tag and its NE
+    type. Id 0 is the sentence boundary.
+    """
+
+    def __init__(self):
+        self.ids = {None: 0}
+        self.kinds = [ENDS]
+        self.types = ["O"]
+
+    def add(self, tag):
+        self.ids[tag] = len(self.kinds)
+        if tag[0] == "O":
+            self.kinds.append(ENDS)
+        elif tag[0] == "B":
+            self.kinds.append(BEGINS)
+        elif tag[0] == "I":
+            self.kinds.append(INSIDE)
+        else:
+            self.kinds.append(OTHER)
+        self.types.append(tag.split("-")[-1])
+
+    def array(self, tags):
+        """
+        Array of the ids of a list of tags; an array of bytes while there
+        are at most 256 distinct tags.
+        """
+        ids = self.ids
+        for tag in set(tags):
+            if tag not in ids:
+                self.add(tag)
+        return array(len(ids) <= 256 and 'B' or 'i', [ids[tag] for tag in tags])
+
+    def corpus_array(self, corpus):
+        """
+        The same as array(corpus.stream()[1]), from the tags of every line
+        of a corpus.Corpus.
+        """
+        ids = self.ids
+        for tag in corpus.tagset:
+            if tag not in ids:
+                self.add(tag)
+        line_ids = dict(ids)
+        line_ids[""] = 0 # blank line
+        return array(len(ids) <= 256 and 'B' or 'i', imap(line_ids.__getitem__, corpus.line_tags))
+
+    def spans(self, tag_ids):
+        """
+        Find the named entities in an array of tag ids. Returns a list of
+        (start, end, type) spans, where end is the position after the last
+        token of the entity, and the start of an entity that is still open
+        at the end of the array (or None).
+        Only the blocks between O tags and sentence boundaries are looked
+        at, a run of equal tags at a time.
+        """
+        kinds = self.kinds
+        types = self.types
+        spans = []
+        open_start = None
+        for first, last in self.blocks(tag_ids):
+            start = None
+            curr_type = None
+            position = first
+            for t, run in groupby(tag_ids[first:last]):
+                length = len(list(run))
+                kind = kinds[t]
+                if kind == INSIDE:
+                    if curr_type != types[t]: # I after O or after another type
+                        if curr_type is not None:
+                            spans.append((start, position, curr_type))
+                        start = position
+                        curr_type = types[t]
+                elif kind == BEGINS:
+                    if curr_type is not None:
+                        spans.append((start, position, curr_type))
+                    curr_type = types[t]
+                    for p in xrange(position, position + length - 1):
+                        spans.append((p, p + 1, curr_type))
+                    start = position + length - 1
+                elif kind == ENDS:
+                    if curr_type is not None:
+                        spans.append((start, position, curr_type))
+                        curr_type = None
+                position += length
+            if curr_type is not None:
+                if last < len(tag_ids): # the tag after the block ends the entity
+                    spans.append((start, last, curr_type))
+                else:
+                    open_start = start
+        return spans, open_start
+
+    def blocks(self, tag_ids):
+        """
+        (first, last) ranges of the maximal blocks of tag_ids without a
+        tag that ends an entity, found with one regular expression over
+        the ids as a byte string. With more than 256 distinct tags the
+        whole array is a single block.
+        """
+        if tag_ids.typecode != 'B' or len(self.kinds) > 256:
+            return [(0, len(tag_ids))]
+        ends = "".join([chr(t) for t, kind in enumerate(self.kinds) if kind == ENDS])
+        text = tag_ids.tostring()
+        return [m.span() for m in re.finditer("[^%s]+" % re.escape(ends), text)]
+
+
+def check_alignment(gs_words, pred_words):
+    """
+    Exit with an error message if the words of the gold standard and the
+    prediction differ.
+    """
+    if gs_words != pred_words:
+        for total, (gs_word, pred_word) in enumerate(map(None, gs_words, pred_words)):
+            if gs_word != pred_word:
+                break
+        sys.stderr.write("Could not align gold standard and predictions in line %i.\n" % (total+1))
+        sys.stderr.write("Gold standard: %s  Prediction file: %s\n" % (gs_word, pred_word))
+        sys.exit(1)
+
+
+def match_spans(gs_tags, pred_tags):
+    """
+    Match the entities of predicted tags against those of gold standard
+    tags, both as lists with None at sentence boundaries. The tags are
+    mapped to integer arrays, the entities of both are extracted as
+    (start, end, type) spans and the spans are matched as sets: an entity
+    is a true positive only if start, end and type all match, so a span
+    with the wrong label counts as a false positive and a false negative.
+    Returns the sets of true positive, false positive and false negative
+    spans and the number of true negative tokens.
+    """
+    index = TagIndex()
+    return match_tag_ids(index, index.array(gs_tags), index.array(pred_tags))
+
+def match_tag_ids(index, gs_ids, pred_ids):
+    """
+    match_spans for arrays of tag ids from the same TagIndex.
+    """
+    gs_spans = set(index.spans(gs_ids)[0])
+    pred_spans, pred_open = index.spans(pred_ids)
+    pred_spans = set(pred_spans)
+
+    # A token is a true negative unless an entity ends there in either
+    # stream or the prediction is inside an entity before it
+    total = len(gs_ids)
+    busy = bytearray(total)
+    for start, end, c in pred_spans:
+        busy[start+1:end+1] = "\x01" * (end - start)
+    if pred_open is not None:
+        busy[pred_open+1:] = "\x01" * (total - pred_open - 1)
+    for start, end, c in gs_spans:
+        busy[end] = 1
+    tn = total - busy.count("\x01")
+    return gs_spans & pred_spans, pred_spans - gs_spans, gs_spans - pred_spans, tn
+
+
+def sentence_counts(gs_tags, pred_tags):
+    """
+    True positive, false positive and false negative counts of every
+    sentence, as three lists. An entity belongs to the sentence it
+    starts in.
+    """
+    boundaries = [i for i, tag in enumerate(gs_tags) if tag is None]
+    sentences = len(boundaries)
+    if gs_tags and gs_tags[-1] is not None:
+        sentences += 1 # the last sentence has no blank line after it
+    counts = []
+    for spans in match_spans(gs_tags, pred_tags)[:3]:
+        sentence = [0] * sentences
+        for start, end, c in spans:
+            sentence[bisect(boundaries, start)] += 1
+        counts.append(sentence)
+    return counts
+
+
 class NeTypeCounts(object):
     """
     Stores true/false positive/negative counts for each NE type.
@@ -96,12 +300,76 @@ class Evaluator(object):
         for c in self.ne_classes:
             self.class_counts[c] = NeTypeCounts()
 
+    def classes(self):
+        """
+        The NE classes in ne_classes followed by any other class that was
+        found in the gold standard or the prediction.
+        """
+        return self.ne_classes + sorted(c for c in self.class_counts if c not in self.ne_classes)
+
     def compare(self, gold_standard, prediction):
         """
         Compare the prediction against a gold standard. Both objects must be
         generator or iterator objects that return a (word, ne_tag) tuple at a
         time.
         """
+        gold = list(gold_standard)
+        pred = list(islice(prediction, len(gold)))
+        self.compare_tags([word for word, tag in gold], [tag for word, tag in gold],
+                          [word for word, tag in pred], [tag for word, tag in pred])
+
+    def compare_files(self, gold_file, prediction_file, with_logprob = False):
+        """
+        Compare a prediction file against a gold standard file.
+        """
+        gold = load_tagged(gold_file)
+        pred = load_tagged(prediction_file, with_logprob)
+        if gold.offsets != pred.offsets or gold.terminated != pred.terminated \
+                or gold.word_list() != pred.word_list():
+            # Let compare_tags align the files line by line
+            gs_words, gs_tags = gold.stream()
+            pred_words, pred_tags = pred.stream()
+            self.compare_tags(gs_words, gs_tags, pred_words[:len(gs_words)], pred_tags[:len(gs_tags)])
+            return
+        index = TagIndex()
+        self.add_matches(*match_tag_ids(index, index.corpus_array(gold), index.corpus_array(pred)))
+
+    def compare_tags(self, gs_words, gs_tags, pred_words, pred_tags):
+        """
+        Compare predicted tags against gold standard tags, both as lists
+        with None at sentence boundaries; see match_spans. The counts are
+        the same as those of compare_tokens.
+        """
+        check_alignment(gs_words, pred_words)
+        self.add_matches(*match_spans(gs_tags, pred_tags))
+
+    def add_matches(self, tp, fp, fn, tn):
+        """
+        Add the result of match_spans to the counts.
+        """
+        for c in set(span[2] for span in tp | fp | fn):
+            if c not in self.class_counts:
+                self.class_counts[c] = NeTypeCounts()
+        for start, end, c in tp:
+            self.tp += 1
+            self.class_counts[c].tp += 1
+        for start, end, c in fp:
+            self.fp += 1
+            self.class_counts[c].fp += 1
+        for start, end, c in fn:
+            self.fn += 1
+            self.class_counts[c].fn += 1
+        self.tn += tn
+        for c in self.class_counts:
+            self.class_counts[c].tn += tn
+
+    def compare_tokens(self, gold_standard, prediction):
+        """
+        Compare the prediction against a gold standard token by token, as
+        compare does. Both objects must be generator or iterator objects
+        that return a (word, ne_tag) tuple at a time.
+        Kept as the reference for compare_tags.
+        """
 
         # Define a couple of tags indicating the status of each stream
         curr_pred_type = None # prediction stream was previously in a named entity
@@ -218,7 +486,7 @@ class Evaluator(object):
         print "\t precision \trecall \t\tF1-Score"
         fscore = (2*prec*rec)/(prec+rec)
         #print "Total:\t %f\t%f\t%f" % (prec, rec, fscore)
-        for c in self.ne_classes:
+        for c in self.classes():
             c_tp = self.class_counts[c].tp
             c_tn = self.class_counts[c].tn
             c_fp = self.class_counts[c].fp
@@ -263,8 +531,6 @@ if __name__ == "__main__":
     if len(sys.argv)!=3:
         usage()
         sys.exit(1)
-    gs_iterator = corpus_iterator(file(sys.argv[1]))
-    pred_iterator = corpus_iterator(file(sys.argv[2]), with_logprob = False)
     evaluator = Evaluator()
-    evaluator.compare(gs_iterator, pred_iterator)
+    evaluator.compare_files(file(sys.argv[1]), file(sys.argv[2]), with_logprob = False)
     evaluator.print_scores()
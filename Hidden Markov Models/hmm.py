@@ -1,8 +1,21 @@
 #/usr/bin/python
 
 import sys
+import time
+import threading
+from Queue import Queue
+from StringIO import StringIO
 from collections import defaultdict
+from array import array
+from multiprocessing import Pool
+from optparse import OptionParser
 import math
+from word_signature import default_signature, get_signature, SIGNATURES
+import model_file
+import smoothing
+from corpus import Corpus, count_ngrams
+import instrument
+from instrument import instrumentation
 
 """
 Count n-gram frequencies in a data file and write counts to
@@ -77,16 +90,17 @@ def test_corpus_iterator(corpus_file):
         l = corpus_file.readline()
 
 def test_sentence_iterator(corpus_iterator):
-    
+    """
+    Sentences (lists of words) of test_corpus_iterator. Blank lines in a
+    row make empty sentences, which are skipped as Corpus.sentences()
+    skips them.
+    """
     current_sentence = [] #Buffer for the current sentence
     for l in corpus_iterator:        
             if l==None:
                 if current_sentence:  #Reached the end of a sentence
                     yield current_sentence
                     current_sentence = [] #Reset buffer
-                else: # Got empty input stream
-                    sys.stderr.write("WARNING: Got empty input file/stream.\n")
-                    raise StopIteration
             else:
                 current_sentence.append(l) #Add token to the buffer
 
@@ -112,21 +126,48 @@ def get_ngrams(sent_iterator, n):
          for n_gram in ngrams: #Return one n-gram at a time
             yield n_gram        
 
-# Useful function to judge the type of rare words
-def isNumeric(word):
-    for c in word:
-        if c.isdigit():
-            return True
-    return False
+NEG_INF = float("-inf")
 
-def isAllCapital(word):
-    for c in word:
-        if c.islower():
-            return False
-    return True
+def log_prob(p):
+    """
+    Log of a probability, mapping zero probability to -inf.
+    """
+    if p <= 0:
+        return NEG_INF
+    return math.log(p)
 
-def isLastCapital(word):
-    return word[len(word)-1].isupper()
+def log_sum(values):
+    """
+    log(sum(exp(v) for v in values)) without underflow.
+    """
+    m = max(values)
+    if m == NEG_INF:
+        return NEG_INF
+    return m + math.log(sum([math.exp(v - m) for v in values]))
+
+def histories(tags, n):
+    """
+    Every tag history of length n-1 in a sentence padded with '*'.
+    """
+    result = [()]
+    for i in xrange(n - 1):
+        result = [('*',) + history for history in result] + \
+                 [(tag,) + history for history in result if history[:1] != ('*',) for tag in tags]
+    return result
+
+
+def prune_states(pi, beam=None, threshold=None):
+    """
+    Keep the beam best entries of a state -> log probability dict, and
+    only those within threshold of the best one.
+    """
+    states = sorted(pi, key=lambda state: (-pi[state], state))
+    if beam is not None:
+        states = states[:beam]
+    if threshold is not None and states:
+        floor = pi[states[0]] - threshold
+        states = [state for state in states if pi[state] >= floor]
+    return dict((state, pi[state]) for state in states)
 
 
 
@@ -135,19 +176,90 @@ class Hmm(object):
     Stores counts for n-grams and emissions. 
     """
 
-    def __init__(self, n=3):
+    # Largest tag set decoded with the dense trigram tables
+    dense_max_tags = 4
+    # Words seen fewer times than this are emitted through their class
+    rare_threshold = 5
+    # Smoothers from smoothing.py, or None for the maximum likelihood estimates
+    transition_smoothing = None
+    emission_smoothing = None
+
+    def __init__(self, n=3, signature=None):
+        """
+        signature maps rare words to their class (see word_signature.py);
+        it must match the one used to replace rare words in training.
+        """
         assert n>=2, "Expecting n>=2."
         self.n = n
+        self.signature = signature or default_signature
         self.emission_counts = defaultdict(int)
         self.ngram_counts = [defaultdict(int) for i in xrange(self.n)]
         self.all_states = set()
+        self.word_counts = None
+        # True while emission_counts are per word, as counted by train
+        self.raw_counts = False
+        self.reset_tables()
+
+    def reset_tables(self):
+        """
+        Drop the compiled tables; q and e fall back to the raw counts.
+        """
+        self.tags = None
+        self.q_table = None
+        self.e_table = None
+
+    def smooth(self, transitions=None, emissions=None):
+        """
+        Use a transition and an emission smoother (see smoothing.py);
+        None keeps the maximum likelihood estimates. The compiled tables
+        are dropped and computed with the smoothers on demand.
+        """
+        self.transition_smoothing = transitions
+        self.emission_smoothing = emissions
+        self.reset_tables()
+
+    def fit_interpolation(self, sentences):
+        """
+        Fit the weights of interpolated transitions by EM on held-out
+        tagged sentences (lists of (word, ne_tag) tuples) instead of by
+        deleted interpolation on the training counts.
+        """
+        if not isinstance(self.transition_smoothing, smoothing.Interpolation):
+            raise smoothing.SmoothingError("only interpolated transitions have weights to fit")
+        heldout = Hmm(self.n, self.signature)
+        heldout.count_sentences(sentences)
+        self.transition_smoothing.prepare(self.ngram_counts)
+        self.transition_smoothing.fit_heldout(heldout.ngram_counts[self.n-1])
+        self.reset_tables()
 
     def train(self, corpus_file):
         """
         Count n-gram frequencies and emission probabilities from a corpus file.
       """
-        ngram_iterator = \
-            get_ngrams(sentence_iterator(simple_conll_corpus_iterator(corpus_file)), self.n)
+        self.count_corpus(Corpus.load(corpus_file))
+
+    def count_corpus(self, corpus):
+        """
+        Add the counts of a tagged corpus.Corpus; the same counts as
+        count_sentences(corpus.tagged_sentences()), but computed on the
+        id arrays of the corpus.
+        """
+        emission_counts, ngram_counts = count_ngrams(corpus, self.n)
+        for key, count in emission_counts.iteritems():
+            self.emission_counts[key] += count
+        for i in xrange(self.n):
+            for ngram, count in ngram_counts[i].iteritems():
+                self.ngram_counts[i][ngram] += count
+        self.all_states.update(corpus.tagset)
+        self.word_counts = None
+        self.raw_counts = True
+        self.reset_tables()
+
+    def count_sentences(self, sentences):
+        """
+        Add the counts of sentences given as lists of (word, ne_tag) tuples.
+        """
+        ngram_iterator = get_ngrams(sentences, self.n)
 
         for ngram in ngram_iterator:
             #Sanity check: n-gram we get from the corpus stream needs to have the right length
@@ -161,33 +273,252 @@ class Hmm(object):
             if ngram[-1][0] is not None: # If this is not the last word in a sentence
                 self.ngram_counts[0][tagsonly[-1:]] += 1 # count 1-gram
                 self.emission_counts[ngram[-1]] += 1 # and emission frequencies
+                self.all_states.add(ngram[-1][1])
 
             # Need to count a single n-1-gram of sentence start symbols per sentence
             if ngram[-2][0] is None: # this is the first n-gram in a sentence
                 self.ngram_counts[self.n - 2][tuple((self.n - 1) * ["*"])] += 1
+        self.word_counts = None
+        self.raw_counts = True
+        self.reset_tables()
+
+    def replace_rare(self):
+        """
+        Fold the emission counts of rare words into the counts of their
+        class, which is what ReplaceRare.py does to the training file.
+        Training on the raw corpus and then calling this gives the same
+        counts as training on the rewritten corpus, but reads the data
+        once and needs no word_freqs.txt or intermediate file. The n-gram
+        counts do not depend on the words and are left alone.
+        The frequency of every word and the per-tag counts of the rare ones
+        are kept in word_counts and rare_counts for update.
+        """
+        word_counts = defaultdict(int)
+        for (word, tag), count in self.emission_counts.iteritems():
+            word_counts[word] += count
+        emission_counts = defaultdict(int)
+        rare_counts = defaultdict(dict)
+        for (word, tag), count in self.emission_counts.iteritems():
+            if word_counts[word] < self.rare_threshold:
+                rare_counts[word][tag] = count
+                word = self.signature(word)
+            emission_counts[(word, tag)] += count
+        self.emission_counts = emission_counts
+        self.word_counts = word_counts
+        self.rare_counts = rare_counts
+        self.reset_tables()
+
+    def update(self, sentences, remove=False):
+        """
+        Add a batch of tagged sentences (lists of (word, ne_tag) tuples) to
+        the counts, or take them out again with remove. The cost depends
+        on the batch, not on the corpus:
+          - only the n-grams and words of the batch are touched;
+          - a word moves between its own counts and those of its class
+            only when its frequency crosses rare_threshold;
+          - compiled tables are patched: the rows of the touched words and
+            classes are rewritten, and the change in the tag counts, which
+            normalize every emission row, is folded into the transition
+            tables (see build_transition_tables).
+        A batch that adds or empties a tag forces a full compile. A batch
+        that removes more than was counted raises ValueError and leaves
+        the model unchanged.
+        The model must know the frequency of every word: train (which
+        replace_rare is called on here) or replace_rare provide it. Counts
+        from read_counts or load_model lack it, the rare words being
+        folded into their classes already, and raise ValueError unless
+        they are raw counts and replace_rare was called on them.
+        """
+        if not self.emission_counts:
+            raise ValueError("No emission counts to update; train or read_counts first.")
+        if self.word_counts is None and not self.raw_counts:
+            raise ValueError("No word frequencies to update; train, or call replace_rare on raw counts, first.")
+        sign = remove and -1 or 1
+        batch = Hmm(self.n, self.signature)
+        batch.count_sentences(sentences)
+        if self.word_counts is None:
+            self.replace_rare()
+
+        # Work out every new count and check the whole batch before
+        # anything is changed, so that a rejected batch leaves the model as it was
+        ngram_totals = []
+        for i in xrange(self.n):
+            for ngram, count in batch.ngram_counts[i].iteritems():
+                total = self.ngram_counts[i].get(ngram, 0) + sign * count
+                if total < 0:
+                    raise ValueError("Removing more %s than was counted." % " ".join(ngram))
+                ngram_totals.append((i, ngram, total))
+        batch_counts = defaultdict(dict)
+        for (word, tag), count in batch.emission_counts.iteritems():
+            batch_counts[word][tag] = sign * count
+        emission_counts = self.emission_counts
+        word_totals = []
+        for word, delta in batch_counts.iteritems():
+            was_rare = self.word_counts.get(word, 0) < self.rare_threshold
+            if was_rare:
+                old_counts = self.rare_counts.get(word, {})
+            else:
+                old_counts = dict((tag, emission_counts[(word, tag)]) for tag in self.all_states
+                                  if (word, tag) in emission_counts)
+            counts = dict(old_counts)
+            for tag, count in delta.iteritems():
+                counts[tag] = counts.get(tag, 0) + count
+                if counts[tag] < 0:
+                    raise ValueError("Removing more (%s, %s) than was counted." % (word, tag))
+            total = self.word_counts.get(word, 0) + sum(delta.itervalues())
+            word_totals.append((word, was_rare, old_counts, counts, total))
+
+        for i, ngram, total in ngram_totals:
+            if total == 0:
+                self.ngram_counts[i].pop(ngram, None)
+            else:
+                self.ngram_counts[i][ngram] = total
+        new_tags = [tag for tag in batch.all_states if tag not in self.all_states]
+        self.all_states.update(batch.all_states)
+
+        words = set()
+        classes = set()
+        for word, was_rare, old_counts, counts, total in word_totals:
+            is_rare = total < self.rare_threshold
+            cls = self.signature(word)
+            # Take the counts of the word out of the tables ...
+            if was_rare:
+                self.rare_counts.pop(word, None)
+                for tag, count in old_counts.iteritems():
+                    emission_counts[(cls, tag)] -= count
+                classes.add(cls)
+            else:
+                for tag in old_counts:
+                    del emission_counts[(word, tag)]
+                words.add(word)
+            # ... and put them back where they belong now
+            if total > 0:
+                self.word_counts[word] = total
+            else:
+                self.word_counts.pop(word, None)
+            for tag, count in counts.iteritems():
+                if count == 0:
+                    continue
+                if is_rare:
+                    self.rare_counts[word][tag] = count
+                    emission_counts[(cls, tag)] += count
+                else:
+                    emission_counts[(word, tag)] = count
+            if is_rare:
+                classes.add(cls)
+            else:
+                words.add(word)
+        for cls in classes:
+            for tag in self.all_states:
+                if emission_counts.get((cls, tag), 1) == 0:
+                    del emission_counts[(cls, tag)]
+
+        if self.tags is None:
+            return
+        # smoothed tables depend on all of the counts
+        smoothed = self.transition_smoothing or self.emission_smoothing
+        if new_tags or smoothed or not isinstance(self.word_ids, dict) or \
+                [tag for tag in self.tags if self.ngram_counts[0].get((tag,), 0) <= 0]:
+            self.reset_tables()
+            return
+        self.update_tables(words, classes)
+
+    def update_tables(self, words, classes):
+        """
+        Rewrite the compiled emission rows of some words and classes and
+        rebuild the (small) transition tables.
+        """
+        K = len(self.tags)
+        def set_row(row, word):
+            values = [self.emission_counts.get((word, tag), 0) * 1.0 / self.row_norms[t]
+                      for t, tag in enumerate(self.tags)]
+            self.e_table[row*K:(row+1)*K] = array('d', values)
+            self.log_rows[row] = [log_prob(p) for p in values]
+        for word in words:
+            if self.word_counts.get(word, 0) < self.rare_threshold:
+                self.word_ids.pop(word, None)
+                continue
+            if word not in self.word_ids:
+                self.e_table.extend([0.0] * K)
+                self.log_rows.append(None)
+                self.word_ids[word] = len(self.log_rows) - 1
+            set_row(self.word_ids[word], word)
+        for cls in classes:
+            if cls in self.class_rows:
+                set_row(self.class_rows[cls], cls)
+
+        if self.n >= 3:
+            states = self.tags + ['*', 'STOP']
+            self.q_table = array('d', [self.q_ngram((t_2, t_1, t)) for t_2 in states
+                                       for t_1 in states for t in states])
+        self.build_transition_tables()
     
     def q(self, t_2, t_1, t):
+        if self.q_table is not None:
+            ids = self.state_ids
+            if t_2 not in ids or t_1 not in ids or t not in ids:
+                return 0
+            S = len(ids)
+            return self.q_table[(ids[t_2] * S + ids[t_1]) * S + ids[t]]
+        if self.transition_smoothing is not None:
+            self.compile()
+            return self.q(t_2, t_1, t)
         if self.ngram_counts[1][(t_2,t_1)] == 0:
             return 0
         return self.ngram_counts[2][(t_2, t_1, t)] * 1.0 / self.ngram_counts[1][(t_2, t_1)]
     
+    def q_ngram(self, ngram):
+        """
+        q(t | history) for a tuple of tags (history..., t) of length 2..n.
+        """
+        if self.transition_smoothing is not None:
+            return self.transition_smoothing.q(ngram)
+        history = ngram[:-1]
+        count = self.ngram_counts[len(history)-1].get(history, 0)
+        if count == 0:
+            return 0
+        return self.ngram_counts[len(ngram)-1].get(ngram, 0) * 1.0 / count
+
     #emission probability, e(word|tag)
     def e(self, word, tag):
-        if self.emission_counts[(word, 'O')] + self.emission_counts[(word,'I-GENE')] < 5:
+        if self.e_table is not None:
+            if tag not in self.tag_ids:
+                return 0
+            t = self.tag_ids[tag]
+            return self.e_table[self.word_row(word) * len(self.tags) + t] * self.emission_scale[t]
+        if self.emission_smoothing is not None:
+            self.compile()
+            return self.e(word, tag)
+        if self.is_rare(word):
             """
             group the rare words to different types
             """
-            if isNumeric(word):
-                return self.emission_counts[('_NUM_', tag)] * 1.0 / self.ngram_counts[0][(tag,)]
-            elif isAllCapital(word):
-                return self.emission_counts[('_ALLCAP_', tag)] * 1.0 / self.ngram_counts[0][(tag,)]
-            elif isLastCapital(word):
-                return self.emission_counts[('_LASTCAP_', tag)] * 1.0 / self.ngram_counts[0][(tag,)]
-            else:
-                return self.emission_counts[('_RARE_', tag)] * 1.0 / self.ngram_counts[0][(tag,)]
+            return self.emission_counts[(self.signature(word), tag)] * 1.0 / self.ngram_counts[0][(tag,)]
         
         return self.emission_counts[(word, tag)] * 1.0/ self.ngram_counts[0][(tag,)]
 
+    def is_rare(self, word):
+        """
+        True if the emissions of word are those of its class: in the
+        compiled tables, if it has no row of its own; otherwise, if it
+        was seen fewer than rare_threshold times.
+        """
+        if self.e_table is not None:
+            return word not in self.word_ids
+        return sum(self.emission_counts.get((word, t), 0) for t in self.all_states) < self.rare_threshold
+
+    def word_row(self, word):
+        """
+        Emission row of a word in the compiled tables; rare and unseen
+        words use the row of their class.
+        """
+        row = self.word_ids.get(word)
+        if row is None:
+            row = self.class_rows.get(self.signature(word))
+            if row is None:
+                row = self.class_rows['_RARE_']
+        return row
+
     """
     the first part of the assignments can use this function to predict the tags
     """
@@ -238,14 +569,524 @@ class Hmm(object):
             Y[i] = bp[i+2][(Y[i+1], Y[i+2])]    
         
         return Y
+
+    def compile(self):
+        """
+        Intern tags and words to integer ids and precompute the probability
+        tables, so that q and e become array lookups. Tags are taken from
+        the 1-gram counts, most frequent first.
+          tag_ids    tag -> index in self.tags
+          state_ids  tag_ids plus '*' and 'STOP'
+          q_table    q(t | t_2, t_1) at (t_2 * S + t_1) * S + t, S = len(state_ids)
+          word_ids   word -> emission row, for words seen rare_threshold times or more
+          class_rows rare class -> emission row
+          e_table    e(word | tag) at row * K + tag index, K = len(tags)
+          log_rows   the same emission rows as lists of log probabilities
+        and the log transition tables used by the decoders:
+          trans[t_1][t][t_2] = log q(t | t_2, t_1)
+          start2[t]          = log q(t | *, *)
+          start1[t_1][t]     = log q(t | *, t_1)
+          stop[t_1][t]       = log q(STOP | t_1, t)
+          stop1[t]           = log q(STOP | *, t)
+        With smoothers set (see smooth), q_table and the emission rows
+        hold the smoothed probabilities.
+        train and read_counts drop the compiled tables; the decoders call
+        compile again on demand. load_model installs the same tables from
+        a binary model file.
+        """
+        self.reset_tables()
+        tags = sorted([ngram[0] for ngram in self.ngram_counts[0] if ngram[0] != '*'],
+                      key=lambda tag: (-self.ngram_counts[0][(tag,)], tag))
+        self.all_states.update(tags)
+        tag_ids = dict((tag, i) for i, tag in enumerate(tags))
+        states = tags + ['*', 'STOP']
+        state_ids = dict((tag, i) for i, tag in enumerate(states))
+
+        word_counts = defaultdict(int)
+        for (word, tag), count in self.emission_counts.iteritems():
+            word_counts[word] += count
+        word_ids = {}
+        class_rows = {}
+        e_table = array('d')
+        log_rows = []
+        tag_counts = [self.ngram_counts[0].get((tag,), 0) for tag in tags]
+        frequent = [word for word, count in word_counts.iteritems() if count >= self.rare_threshold]
+        smoother = self.emission_smoothing
+        if smoother is not None:
+            smoother.prepare(self, tags, tag_counts, self.signature.classes + frequent)
+        def add_row(word):
+            if smoother is not None:
+                row = smoother.row(word)
+            else:
+                row = [self.emission_counts.get((word, tag), 0) * 1.0 / tag_counts[t] if tag_counts[t] else 0.0
+                       for t, tag in enumerate(tags)]
+            e_table.extend(row)
+            log_rows.append([log_prob(p) for p in row])
+            return len(log_rows) - 1
+        for cls in self.signature.classes:
+            class_rows[cls] = add_row(cls)
+        for word in frequent:
+            word_ids[word] = add_row(word)
+
+        if self.transition_smoothing is not None:
+            self.transition_smoothing.prepare(self.ngram_counts)
+        if self.n >= 3:
+            self.q_table = array('d', [self.q_ngram((t_2, t_1, t)) for t_2 in states
+                                       for t_1 in states for t in states])
+        self.tags = tags
+        self.tag_ids = tag_ids
+        self.state_ids = state_ids
+        self.word_ids = word_ids
+        self.class_rows = class_rows
+        self.e_table = e_table
+        self.log_rows = log_rows
+        self.row_norms = tag_counts
+        self.build_transition_tables()
+
+    def build_transition_tables(self):
+        """
+        Log transition tables of the decoders, from the compiled q_table
+        and the n-gram counts.
+        Emission rows are normalized by the tag counts in row_norms. When
+        update has changed the tag counts since, e(word|t) is off by the
+        factor row_norms[t] / count(t) for every word. Every emission of t
+        comes with exactly one transition into t, so the decoders add the
+        log of that factor (emission_shift) to the transitions into t and
+        e() multiplies by it (emission_scale). Right after compile the
+        shift is 0.0 and the scale 1.0, which leave the scores unchanged.
+        """
+        tags = self.tags
+        tag_counts = [self.ngram_counts[0].get((tag,), 0) for tag in tags]
+        self.emission_scale = [norm == count and 1.0 or norm * 1.0 / count
+                               for norm, count in zip(self.row_norms, tag_counts)]
+        self.emission_shift = [scale == 1.0 and 0.0 or math.log(scale) for scale in self.emission_scale]
+        shift = self.emission_shift
+        self.build_successors()
+        if self.n != 3:
+            return
+        self.trans = [[[log_prob(self.q(t_2, t_1, t)) + shift[t_] for t_2 in tags]
+                       for t_, t in enumerate(tags)] for t_1 in tags]
+        self.start2 = [log_prob(self.q('*', '*', t)) + shift[t_] for t_, t in enumerate(tags)]
+        self.start1 = [[log_prob(self.q('*', t_1, t)) + shift[t_] for t_, t in enumerate(tags)] for t_1 in tags]
+        self.stop = [[log_prob(self.q(t_1, t, 'STOP')) for t in tags] for t_1 in tags]
+        self.stop1 = [log_prob(self.q('*', t, 'STOP')) for t in tags]
+
+    def build_successors(self):
+        """
+        Index the observed n-grams by history for predict_ngram:
+          successors[history] = [(tag index, tag, log q(tag | history)), ...]
+          stop_scores[history] = log q(STOP | history)
+        Unseen n-grams have probability zero and are left out, so the
+        decoder never expands them. With smoothed transitions every
+        n-gram a sentence can have is indexed.
+        """
+        index = dict((tag, i) for i, tag in enumerate(self.tags))
+        self.successors = defaultdict(list)
+        self.stop_scores = {}
+        if self.transition_smoothing is None:
+            ngrams = self.ngram_counts[self.n-1]
+        else:
+            ngrams = [history + (tag,) for history in histories(self.tags, self.n)
+                      for tag in self.tags + ['STOP']]
+        for ngram in ngrams:
+            p = self.q_ngram(ngram)
+            if p <= 0:
+                continue
+            if ngram[-1] == 'STOP':
+                self.stop_scores[ngram[:-1]] = math.log(p)
+            elif ngram[-1] in index:
+                t = index[ngram[-1]]
+                self.successors[ngram[:-1]].append((t, ngram[-1], math.log(p) + self.emission_shift[t]))
+        for successors in self.successors.itervalues():
+            successors.sort()
+
+    def use_dense(self):
+        """
+        The dense trigram tables pay off only for small tag sets; larger
+        tag sets and other orders go through the pruned predict_ngram.
+        """
+        return self.n == 3 and len(self.tags) <= self.dense_max_tags
+
+    def emission_table(self, sentence):
+        """
+        Return one row of log e(word|tag) values per word in the sentence.
+        """
+        log_rows = self.log_rows
+        return [log_rows[self.word_row(w)] for w in sentence]
+
+    def predict_viterbi(self, sentence):
+        """
+        Trigram Viterbi decoding in log space over the compiled tables.
+        pi[t_1][t] holds the best log score of a path ending in t_1, t; for
+        every position the max over t_2 is taken with plain list indexing
+        instead of calling q and e once per lattice cell. Ties go to the
+        first tag in self.tags, as in predict_p3.
+        """
+        if self.tags is None:
+            self.compile()
+        if not self.use_dense():
+            return self.predict_ngram(sentence)
+        tags = self.tags
+        R = range(len(tags))
+        s_len = len(sentence)
+        if s_len == 0:
+            return []
+        emissions = self.emission_table(sentence)
+
+        pi0 = [self.start2[t] + emissions[0][t] for t in R]
+        if s_len == 1:
+            scores = [pi0[t] + self.stop1[t] for t in R]
+            return [tags[scores.index(max(scores))]]
+
+        e1 = emissions[1]
+        pi = [[pi0[t_1] + self.start1[t_1][t] + e1[t] for t in R] for t_1 in R]
+        bp = [None, None]
+        trans = self.trans
+        for i in xrange(2, s_len):
+            e_i = emissions[i]
+            new_pi = []
+            back = []
+            for t_1 in R:
+                column = [pi[t_2][t_1] for t_2 in R]
+                trans_1 = trans[t_1]
+                row = []
+                back_row = []
+                for t in R:
+                    trans_1t = trans_1[t]
+                    best = NEG_INF
+                    arg = 0
+                    for t_2 in R:
+                        score = column[t_2] + trans_1t[t_2]
+                        if score > best:
+                            best = score
+                            arg = t_2
+                    row.append(best + e_i[t])
+                    back_row.append(arg)
+                new_pi.append(row)
+                back.append(back_row)
+            pi = new_pi
+            bp.append(back)
+
+        best = NEG_INF
+        y_1, y = 0, 0
+        for t_1 in R:
+            for t in R:
+                score = pi[t_1][t] + self.stop[t_1][t]
+                if score > best:
+                    best = score
+                    y_1, y = t_1, t
+
+        Y = [0] * s_len
+        Y[s_len-2] = y_1
+        Y[s_len-1] = y
+        for i in xrange(s_len-3, -1, -1):
+            Y[i] = bp[i+2][Y[i+1]][Y[i+2]]
+        return [tags[t] for t in Y]
+
+    def predict_kbest(self, sentence, k):
+        """
+        The k best tag sequences of a trigram model, as (log probability,
+        tags) pairs, best first. Each lattice cell (t_1, t) keeps its k
+        best partial paths; a back pointer is the pair (t_2, rank of the
+        path in cell (t_2, t_1) one position earlier).
+        """
+        assert self.n == 3, "k-best decoding needs a trigram model."
+        if self.tags is None:
+            self.compile()
+        tags = self.tags
+        R = range(len(tags))
+        s_len = len(sentence)
+        if s_len == 0:
+            return [(0.0, [])]
+        emissions = self.emission_table(sentence)
+
+        pi0 = [self.start2[t] + emissions[0][t] for t in R]
+        if s_len == 1:
+            scores = sorted([(pi0[t] + self.stop1[t], t) for t in R], key=lambda x: -x[0])
+            return [(score, [tags[t]]) for score, t in scores[:k] if score > NEG_INF]
+
+        # cells[t_1][t] = [(score, t_2, rank), ...] sorted best first
+        e1 = emissions[1]
+        cells = [[[(pi0[t_1] + self.start1[t_1][t] + e1[t], None, 0)] for t in R] for t_1 in R]
+        lattice = [None, cells]
+        trans = self.trans
+        for i in xrange(2, s_len):
+            e_i = emissions[i]
+            new_cells = []
+            for t_1 in R:
+                row = []
+                for t in R:
+                    trans_1t = trans[t_1][t]
+                    candidates = [(score + trans_1t[t_2], t_2, rank)
+                                  for t_2 in R for rank, (score, b, r) in enumerate(cells[t_2][t_1])]
+                    candidates.sort(key=lambda x: -x[0])
+                    row.append([(score + e_i[t], t_2, rank)
+                                for score, t_2, rank in candidates[:k] if score > NEG_INF])
+                new_cells.append(row)
+            cells = new_cells
+            lattice.append(cells)
+
+        finals = [(score + self.stop[t_1][t], t_1, t, rank)
+                  for t_1 in R for t in R for rank, (score, b, r) in enumerate(cells[t_1][t])]
+        finals.sort(key=lambda x: -x[0])
+        result = []
+        for score, t_1, t, rank in finals[:k]:
+            if score == NEG_INF:
+                break
+            Y = [t, t_1]
+            for i in xrange(s_len-1, 1, -1):
+                entry = lattice[i][Y[-1]][Y[-2]][rank]
+                Y.append(entry[1])
+                rank = entry[2]
+            Y.reverse()
+            result.append((score, [tags[y] for y in Y]))
+        return result
+
+    def posteriors(self, sentence):
+        """
+        Forward-backward over the trigram lattice. Returns (log Z, P) where
+        Z is the total probability of the sentence and P[i][t] is the
+        posterior probability of self.tags[t] at position i. Uses the
+        same tables as predict_viterbi, with log_sum in place of max.
+        """
+        assert self.n == 3, "Posteriors need a trigram model."
+        if self.tags is None:
+            self.compile()
+        R = range(len(self.tags))
+        s_len = len(sentence)
+        if s_len == 0:
+            return 0.0, []
+        emissions = self.emission_table(sentence)
+        trans = self.trans
+
+        alpha0 = [self.start2[t] + emissions[0][t] for t in R]
+        if s_len == 1:
+            scores = [alpha0[t] + self.stop1[t] for t in R]
+            Z = log_sum(scores)
+            return Z, [[math.exp(s - Z) for s in scores]]
+
+        # alpha[i][t_1][t]: paths over words 0..i ending in t_1, t
+        e1 = emissions[1]
+        alpha = [None, [[alpha0[t_1] + self.start1[t_1][t] + e1[t] for t in R] for t_1 in R]]
+        for i in xrange(2, s_len):
+            prev = alpha[-1]
+            e_i = emissions[i]
+            alpha.append([[log_sum([prev[t_2][t_1] + trans[t_1][t][t_2] for t_2 in R]) + e_i[t]
+                           for t in R] for t_1 in R])
+        Z = log_sum([alpha[-1][t_1][t] + self.stop[t_1][t] for t_1 in R for t in R])
+
+        # beta[i][t_1][t]: paths over words i+1.. given t_1, t at i-1, i
+        beta = [None] * s_len
+        beta[-1] = [[self.stop[t_1][t] for t in R] for t_1 in R]
+        for i in xrange(s_len-2, 0, -1):
+            nxt = beta[i+1]
+            e_i = emissions[i+1]
+            beta[i] = [[log_sum([trans[t_1][t][t_2] + e_i[t] + nxt[t_1][t] for t in R])
+                        for t_1 in R] for t_2 in R]
+        beta0 = [log_sum([self.start1[t_1][t] + e1[t] + beta[1][t_1][t] for t in R]) for t_1 in R]
+
+        P = [[math.exp(alpha0[t] + beta0[t] - Z) for t in R]]
+        for i in xrange(1, s_len):
+            P.append([math.exp(log_sum([alpha[i][t_1][t] + beta[i][t_1][t] for t_1 in R]) - Z)
+                      for t in R])
+        return Z, P
+
+    def predict_ngram(self, sentence, beam=None, threshold=None):
+        """
+        Viterbi decoding in log space for an HMM of order self.n over the
+        tags seen in training. A state is the tuple of the last n-1 tags;
+        only states reachable through observed n-grams and tags with a
+        nonzero emission are kept in the lattice.
+        If no state survives a position, that position falls back to a
+        flat transition score from the best state so far, so there is
+        always a real path to trace back.
+        With beam and/or threshold set the search is approximate: see
+        predict_beam.
+        """
+        if self.tags is None:
+            self.compile()
+        tags = self.tags
+        successors = self.successors
+        flat = math.log(1.0 / len(tags))
+        emissions = self.emission_table(sentence)
+        pi = {tuple((self.n - 1) * ['*']): 0.0}
+        bp = []
+        for e_i in emissions:
+            new_pi = {}
+            back = {}
+            for state, score in pi.iteritems():
+                for t, tag, lq in successors.get(state, ()):
+                    if e_i[t] == NEG_INF:
+                        continue
+                    s = score + lq + e_i[t]
+                    if s > new_pi.get(state[1:] + (tag,), NEG_INF):
+                        new_pi[state[1:] + (tag,)] = s
+                        back[state[1:] + (tag,)] = state
+            if not new_pi:
+                state = max(pi, key=pi.get)
+                for t, tag in enumerate(tags):
+                    new_pi[state[1:] + (tag,)] = pi[state] + flat + max(e_i[t], flat)
+                    back[state[1:] + (tag,)] = state
+            if beam is not None or threshold is not None:
+                new_pi = prune_states(new_pi, beam, threshold)
+            pi = new_pi
+            bp.append(back)
+
+        if not bp:
+            return []
+        stop_scores = self.stop_scores
+        best = max(pi, key=lambda state: (pi[state] + stop_scores.get(state, NEG_INF), pi[state]))
+        Y = []
+        for back in reversed(bp):
+            Y.append(best[-1])
+            best = back[best]
+        Y.reverse()
+        return Y
+
+    def predict_beam(self, sentence, beam=8, threshold=None):
+        """
+        Approximate Viterbi decoding: after every position only the beam
+        best states (the last n-1 tags, (t_1, t) for a trigram model) are
+        kept, and with threshold only the states whose log probability is
+        within threshold of the best one. A position then costs
+        O(beam * K) instead of O(K^(n-1) * K), at the risk of pruning the
+        best path.
+        """
+        return self.predict_ngram(sentence, beam, threshold)
+
+    def decode(self, sentences, beam=None, threshold=None):
+        """
+        Tag a list of sentences: exactly with predict_batch, or with
+        predict_beam if a beam width or threshold is given.
+        """
+        if beam is None and threshold is None:
+            return self.predict_batch(sentences)
+        return [self.predict_beam(sentence, beam, threshold) for sentence in sentences]
+
+    def predict_batch(self, sentences, batch_size=256):
+        """
+        Decode many sentences at once. Sentences are sorted by length and
+        cut into buckets of at most batch_size; within a bucket every
+        lattice cell is updated for all sentences in one list
+        comprehension. Since a bucket is sorted longest first, the
+        sentences still running at position i are always a prefix of it,
+        which is how shorter sentences are masked out. Returns the same
+        tag sequences as predict_viterbi, in input order.
+        """
+        if self.tags is None:
+            self.compile()
+        if not self.use_dense():
+            return [self.predict_ngram(sentence) for sentence in sentences]
+        order = sorted([k for k in xrange(len(sentences)) if sentences[k]],
+                       key=lambda k: -len(sentences[k]))
+        result = [[] for s in sentences]
+        for start in xrange(0, len(order), batch_size):
+            bucket = order[start:start+batch_size]
+            decoded = self._viterbi_bucket([sentences[k] for k in bucket])
+            for k, Y in zip(bucket, decoded):
+                result[k] = Y
+        return result
+
+    def _viterbi_bucket(self, sentences):
+        """
+        Batched trigram Viterbi over sentences sorted longest first.
+        pi[t_1][t] is a list with one score per sentence still active.
+        """
+        tags = self.tags
+        R = range(len(tags))
+        lengths = [len(s) for s in sentences]
+        emissions = [self.emission_table(s) for s in sentences]
+        # active[i] is the number of sentences that have a word at position i
+        active = [0] * (max(lengths) + 2)
+        for l in lengths:
+            for i in xrange(l):
+                active[i] += 1
+        last = [[] for s in sentences] # best tag indices for the last two words
+
+        a = active[0]
+        pi0 = [[self.start2[t] + emissions[b][0][t] for b in xrange(a)] for t in R]
+        for b in xrange(active[1], a):
+            scores = [pi0[t][b] + self.stop1[t] for t in R]
+            last[b] = [scores.index(max(scores))]
+
+        a = active[1]
+        pi = [[[pi0[t_1][b] + self.start1[t_1][t] + emissions[b][1][t] for b in xrange(a)]
+               for t in R] for t_1 in R]
+        bp = [None, None]
+        trans = self.trans
+        i = 1
+        while active[i]:
+            # Close the sentences whose last word is at position i
+            for b in xrange(active[i+1], active[i]):
+                best = NEG_INF
+                y_1, y = 0, 0
+                for t_1 in R:
+                    for t in R:
+                        score = pi[t_1][t][b] + self.stop[t_1][t]
+                        if score > best:
+                            best = score
+                            y_1, y = t_1, t
+                last[b] = [y_1, y]
+            i += 1
+            a = active[i]
+            if a == 0:
+                break
+            e_i = [[emissions[b][i][t] for b in xrange(a)] for t in R]
+            new_pi = []
+            back = []
+            for t_1 in R:
+                column = [pi[t_2][t_1][:a] for t_2 in R]
+                trans_1 = trans[t_1]
+                row = []
+                back_row = []
+                for t in R:
+                    trans_1t = trans_1[t]
+                    tr = trans_1t[0]
+                    best = [p + tr for p in column[0]]
+                    arg = [0] * a
+                    for t_2 in R[1:]:
+                        tr = trans_1t[t_2]
+                        score = [p + tr for p in column[t_2]]
+                        arg = [t_2 if s > m else g for s, m, g in zip(score, best, arg)]
+                        best = [s if s > m else m for s, m in zip(score, best)]
+                    row.append([m + e for m, e in zip(best, e_i[t])])
+                    back_row.append(arg)
+                new_pi.append(row)
+                back.append(back_row)
+            pi = new_pi
+            bp.append(back)
+
+        result = []
+        for b, s_len in enumerate(lengths):
+            Y = [0] * (s_len - len(last[b])) + last[b]
+            for i in xrange(s_len-3, -1, -1):
+                Y[i] = bp[i+2][Y[i+1]][Y[i+2]][b]
+            result.append([tags[t] for t in Y])
+        return result
                         
 
-    def write_counts(self, output, printngrams=[1,2,3]):
+    def save_model(self, filename):
+        """
+        Write the compiled model to a binary model file (see model_file.py).
+        """
+        model_file.save_model(self, filename)
+
+    def load_model(self, filename, with_counts=False):
+        """
+        Map a binary model file written by save_model. The tables stay in
+        the file; with_counts also reads the emission counts, which only
+        write_counts needs.
+        """
+        model_file.load_model(self, filename, with_counts)
+
+    def write_counts(self, output, printngrams=None):
         """
         Writes counts to the output file object.
         Format:
 
         """
+        if printngrams is None:
+            printngrams = range(1, self.n+1)
         # First write counts for emissions
         for word, ne_tag in self.emission_counts:            
             output.write("%i WORDTAG %s %s\n" % (self.emission_counts[(word, ne_tag)], ne_tag, word))
@@ -258,11 +1099,15 @@ class Hmm(object):
                 output.write("%i %i-GRAM %s\n" %(self.ngram_counts[n-1][ngram], n, ngramstr))
 
     def read_counts(self, corpusfile):
-
-        self.n = 3
+        """
+        Read counts written by write_counts. The order of the model is the
+        longest n-gram in the file.
+        """
         self.emission_counts = defaultdict(int)
-        self.ngram_counts = [defaultdict(int) for i in xrange(self.n)]
+        ngram_counts = defaultdict(dict)
         self.all_states = set()
+        self.word_counts = None
+        self.raw_counts = False
 
         for line in corpusfile:
             parts = line.strip().split(" ")
@@ -275,27 +1120,272 @@ class Hmm(object):
             elif parts[1].endswith("GRAM"):
                 n = int(parts[1].replace("-GRAM",""))
                 ngram = tuple(parts[2:])
-                self.ngram_counts[n-1][ngram] = count
+                ngram_counts[n][ngram] = count
+
+        if ngram_counts:
+            self.n = max(ngram_counts)
+        self.ngram_counts = [defaultdict(int, ngram_counts[i+1]) for i in xrange(self.n)]
+        self.reset_tables()
+
+
+instrumentation.register(Hmm)
+
+
+# Model used by the tagging workers. It is set before the pool is created,
+# so forked workers share the parent's copy instead of unpickling one.
+_tagger = None
+
+def _tag_chunk(chunk, beam=None, threshold=None):
+    """
+    Tag a chunk in a worker process. Returns the tags and what the
+    worker counted and timed meanwhile (None with instrumentation off).
+    """
+    if instrumentation.mode == "off":
+        return _tagger.decode(chunk, beam, threshold), None
+    snapshot = instrumentation.snapshot()
+    with instrumentation.stage("decode"):
+        tags = _tagger.decode(chunk, beam, threshold)
+    return tags, instrumentation.since(snapshot)
+
+def _chunk_results(chunk, result):
+    tags, delta = result.get()
+    if delta is not None:
+        instrumentation.merge(delta)
+    return zip(chunk, tags)
+
+def chunks(sentences, chunk_size):
+    """
+    Group an iterable of sentences into lists of chunk_size sentences.
+    """
+    chunk = []
+    for sentence in sentences:
+        chunk.append(sentence)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _feed_pool(pool, sentences, chunk_size, beam, threshold, pending, stop):
+    """
+    Read chunks of sentences and hand them to the pool, queueing
+    (chunk, result) in pending, then None at the end of the input or
+    (None, exc_info) if reading fails. Stops at the next chunk once stop
+    is set.
+    """
+    try:
+        for chunk in chunks(sentences, chunk_size):
+            if stop.is_set():
+                return
+            pending.put((chunk, pool.apply_async(_tag_chunk, (chunk, beam, threshold))))
+        pending.put(None)
+    except Exception:
+        pending.put((None, sys.exc_info()))
 
+def tag_sentences(hmm, sentences, processes=1, chunk_size=500, beam=None, threshold=None):
+    """
+    Tag an iterable of sentences and yield (sentence, tags) pairs in input
+    order. With processes > 1 chunks of sentences are tagged by a pool of
+    forked worker processes that share the compiled model. beam and
+    threshold select the approximate decoder (see Hmm.decode).
+    Sentences are pulled from the iterable only as they are needed: one
+    chunk at a time, or at most 2 * processes chunks in flight with a
+    pool, so memory stays flat on an input stream of any length. With a
+    pool the iterable is read by a separate thread, so every chunk is
+    yielded as soon as it is tagged, even while the next input is slow
+    to arrive (e.g. on a pipe).
+    """
+    global _tagger
+    if hmm.tags is None:
+        hmm.compile() # before forking, so the workers inherit the tables
+    if processes <= 1:
+        for chunk in chunks(sentences, chunk_size):
+            with instrumentation.stage("decode"):
+                tags = hmm.decode(chunk, beam, threshold)
+            for pair in zip(chunk, tags):
+                yield pair
+        return
+
+    _tagger = hmm
+    pool = Pool(processes)
+    pending = Queue(2 * processes)
+    stop = threading.Event()
+    feeder = threading.Thread(target=_feed_pool,
+                              args=(pool, sentences, chunk_size, beam, threshold, pending, stop))
+    feeder.daemon = True
+    feeder.start()
+    finished = False
+    try:
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            chunk, result = item
+            if chunk is None:
+                raise result[0], result[1], result[2]
+            for pair in _chunk_results(chunk, result):
+                yield pair
+        finished = True
+    finally:
+        # the feeder may still be waiting for input; it stops at the next
+        # chunk, and emptying the queue unblocks a pending put
+        stop.set()
+        while not pending.empty():
+            pending.get_nowait()
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+        _tagger = None
+
+def write_tagged(output, tagged, flush=False):
+    """
+    Write (sentence, tags) pairs in the format of the training data. With
+    flush set every sentence is flushed as soon as it is written.
+    """
+    for sentence, Y in tagged:
+        with instrumentation.stage("write"):
+            for i in range(0, len(sentence)):
+                output.write(sentence[i] + " " + Y[i] + '\n')
+            output.write("\n")
+            if flush:
+                output.flush()
+
+def benchmark_beams(hmm, sentences, key_file, beams, threshold=None):
+    """
+    Tag sentences exactly and with every beam width in beams and score
+    each run against the tagged key_file with eval_gene_tagger.Evaluator.
+    Returns (beam, tokens/sec, F1) rows; beam is None for the exact run.
+    """
+    from eval_gene_tagger import Evaluator, corpus_iterator
+    if hmm.tags is None:
+        hmm.compile()
+    tokens = sum([len(sentence) for sentence in sentences])
+    rows = []
+    for beam in [None] + list(beams):
+        start = time.time()
+        if beam is None:
+            tags = hmm.decode(sentences)
+        else:
+            tags = hmm.decode(sentences, beam, threshold)
+        elapsed = time.time() - start
+        output = StringIO()
+        write_tagged(output, zip(sentences, tags))
+        output.seek(0)
+        key_file.seek(0)
+        evaluator = Evaluator()
+        evaluator.compare(corpus_iterator(key_file), corpus_iterator(output))
+        counts = evaluator.class_counts["GENE"]
+        f1 = counts.tp and 2.0 * counts.tp / (2 * counts.tp + counts.fp + counts.fn) or 0.0
+        rows.append((beam, tokens / max(elapsed, 1e-9), f1))
+    return rows
+
+
+def usage():
+    return """
+    python hmm.py [options] [input_file] [output_file]
+        Tag the words in input_file (one word per line, blank lines between
+        sentences) and write word/tag lines to output_file.
+        Defaults: gene.test and gene_test.p3.out, trained on gene.train.
+        Use - for stdin/stdout; tagged sentences are then written as soon
+        as they are decoded, e.g.
+            tokenize | python hmm.py -m gene.hmmb - - | index
+        With --benchmark, tag input_file exactly and with several beam
+        widths and compare speed and F1, e.g.
+            python hmm.py -m gene.hmmb --benchmark gene.key gene.dev
+        --transitions and --emissions train a smoothed model (smoothing.py), e.g.
+            python hmm.py --transitions interpolate --emissions class gene.dev out"""
 
 if __name__ == "__main__":
 
+    parser = OptionParser(usage=usage())
+    parser.add_option("-t", "--train", default="gene.train",
+                      help="tagged training file; rare words are folded into their classes")
+    parser.add_option("-m", "--model", help="binary model file to load instead of training")
+    parser.add_option("--signature", choices=sorted(SIGNATURES),
+                      help="word classes of rare words, as given to ReplaceRare.py: basic or rich (default basic)")
+    parser.add_option("-s", "--save-model", help="write the trained model to this file")
+    parser.add_option("-p", "--processes", type="int", default=1, help="number of tagging processes")
+    parser.add_option("-c", "--chunk-size", type="int",
+                      help="sentences tagged at a time (default 500, 1 when reading stdin)")
+    parser.add_option("-i", "--instrument", choices=instrument.MODES,
+                      help="off, counters, profile or sample; a summary goes to stderr "
+                           "(default: $HMM_INSTRUMENT or off)")
+    parser.add_option("-b", "--beam", type="int",
+                      help="approximate decoding, keeping this many states per position")
+    parser.add_option("--threshold", type="float",
+                      help="approximate decoding, dropping states this far (in log probability) below the best")
+    parser.add_option("--benchmark", metavar="KEY_FILE",
+                      help="tag the input exactly and with every width in --beams and report tokens/sec and F1 against KEY_FILE")
+    parser.add_option("--beams", default="1,2,4,8,16",
+                      help="comma separated beam widths for --benchmark (default 1,2,4,8,16)")
+    parser.add_option("--transitions", choices=["mle"] + sorted(smoothing.TRANSITIONS), default="mle",
+                      help="transition estimates: mle, interpolate or backoff (Kneser-Ney)")
+    parser.add_option("--lambdas",
+                      help="comma separated weights of the 1-gram ... n-gram estimates for --transitions interpolate "
+                           "(default: fit by deleted interpolation)")
+    parser.add_option("--heldout", metavar="TAGGED_FILE",
+                      help="fit the --transitions interpolate weights on this tagged file")
+    parser.add_option("--emissions", choices=["mle"] + sorted(smoothing.EMISSIONS), default="mle",
+                      help="emission estimates: mle, add-lambda or class")
+    parser.add_option("--emission-weight", type="float",
+                      help="lambda of add-lambda (default 0.1), pseudo-counts of class (default 1)")
+    options, args = parser.parse_args()
+    if options.instrument:
+        instrumentation.configure(options.instrument)
+    if len(args) > 2:
+        parser.error("expecting at most an input and an output file")
+    if options.model and (options.transitions != "mle" or options.emissions != "mle" or options.heldout):
+        parser.error("a model file keeps the smoothing it was saved with")
+    if options.model and options.signature:
+        parser.error("a model file keeps the signature it was saved with")
+    input_name = len(args) > 0 and args[0] or 'gene.test'
+    output_name = len(args) > 1 and args[1] or 'gene_test.p3.out'
+
     # Initialize a trigram counter
-    hmm = Hmm(3)
-    # training file after replacing some rare words 
-    hmm.train(open('gene.rare.group.train'))
-    
-    test_file = test_corpus_iterator(open('gene.test'))
-    #test_file = test_corpus_iterator(open('gene.dev'))
-    test_sentences = test_sentence_iterator(test_file)
-    fo = open('gene_test.p3.out', 'w')
-    #fo = open('gene_dev.p3.out', 'w')
-
-    for sentence in test_sentences:
-        print sentence
-        Y = hmm.predict_p3(sentence)
-        for i in range(0, len(sentence)):
-            fo.write(sentence[i] + " " + Y[i] + '\n')
-        fo.write("\n")
-    fo.close()
-        
+    hmm = Hmm(3, get_signature(options.signature or "basic"))
+    if options.model:
+        hmm.load_model(options.model)
+    else:
+        # count the raw training file, then fold rare words into their classes
+        hmm.train(open(options.train))
+        hmm.replace_rare()
+        transitions = emissions = None
+        if options.transitions == "interpolate":
+            transitions = smoothing.Interpolation(
+                options.lambdas and [float(l) for l in options.lambdas.split(",")])
+        elif options.transitions == "backoff":
+            transitions = smoothing.KneserNey()
+        if options.emissions != "mle":
+            weight = options.emission_weight
+            emissions = smoothing.EMISSIONS[options.emissions](*(weight is not None and [weight] or []))
+        hmm.smooth(transitions, emissions)
+        if options.heldout:
+            hmm.fit_interpolation(Corpus.load(open(options.heldout)).tagged_sentences())
+    if options.save_model:
+        hmm.save_model(options.save_model)
+
+    if options.benchmark:
+        input_file = input_name == '-' and sys.stdin or open(input_name)
+        test_sentences = list(Corpus.load(input_file, tagged=False).sentences())
+        beams = [int(beam) for beam in options.beams.split(",")]
+        print "beam\ttokens/sec\tF1"
+        for beam, speed, f1 in benchmark_beams(hmm, test_sentences, open(options.benchmark),
+                                               beams, options.threshold):
+            print "%s\t%.0f\t%f" % (beam is None and "exact" or beam, speed, f1)
+        sys.exit(0)
+
+    streaming = input_name == '-'
+    chunk_size = options.chunk_size or (streaming and 1 or 500)
+    fo = output_name == '-' and sys.stdout or open(output_name, 'w')
+    if streaming:
+        test_sentences = instrumentation.timed("parse", test_sentence_iterator(test_corpus_iterator(sys.stdin)))
+    else:
+        with instrumentation.stage("parse"):
+            test_sentences = Corpus.load(open(input_name), tagged=False).sentences()
+    write_tagged(fo, tag_sentences(hmm, test_sentences, options.processes, chunk_size,
+                                   options.beam, options.threshold),
+                 flush=streaming)
+    if fo is not sys.stdout:
+        fo.close()
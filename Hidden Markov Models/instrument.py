@@ -0,0 +1,276 @@
+#! /usr/bin/python
+
+import os
+import sys
+import time
+import atexit
+import signal
+import cProfile
+import pstats
+from collections import defaultdict
+from StringIO import StringIO
+
+"""
+Counters, stage timings and profiles for the tagger.
+
+The mode comes from the HMM_INSTRUMENT environment variable, or from
+configure() (python hmm.py --instrument MODE):
+
+    off       nothing is recorded (the default)
+    counters  calls to q, e and word_row, rare-word fallbacks, emission
+              misses, sentences and tokens tagged, and the time spent
+              parsing input, decoding and writing output
+    profile   stage timings and a cProfile profile of the process
+    sample    stage timings and a statistical profile: the function on
+              top of the stack is recorded every HMM_SAMPLE_INTERVAL
+              seconds of CPU time (default 0.001)
+
+The counters are collected by wrapping methods of the registered classes
+(hmm.Hmm) while the mode is counters, so with instrumentation off the
+hot path is the plain code, and stage() and timed() return at once.
+A summary is written to stderr when the process exits,
+or on demand with report().
+"""
+
+MODES = ["off", "counters", "profile", "sample"]
+
+
+class InstrumentError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    """
+    Context manager adding the time spent inside it to a stage.
+    """
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings[self.name] += time.time() - self.start
+        return False
+
+
+def _counted_q(counters, q):
+    def counted_q(self, t_2, t_1, t):
+        counters["q"] += 1
+        return q(self, t_2, t_1, t)
+    return counted_q
+
+def _counted_e(counters, e):
+    def counted_e(self, word, tag):
+        counters["e"] += 1
+        if self.e_table is None and self.is_rare(word):
+            counters["rare_fallback"] += 1 # compiled lookups count in word_row
+        p = e(self, word, tag)
+        if p == 0:
+            counters["emission_miss"] += 1
+        return p
+    return counted_e
+
+def _counted_word_row(counters, word_row):
+    def counted_word_row(self, word):
+        counters["word_row"] += 1
+        if word not in self.word_ids:
+            counters["rare_fallback"] += 1
+        return word_row(self, word)
+    return counted_word_row
+
+def _counted_emission_table(counters, emission_table):
+    neg_inf = float("-inf")
+    def counted_emission_table(self, sentence):
+        rows = emission_table(self, sentence)
+        for row in rows:
+            counters["emission_miss"] += row.count(neg_inf)
+        return rows
+    return counted_emission_table
+
+def _counted_decode(counters, decode):
+    def counted_decode(self, sentences, *args, **kwargs):
+        counters["sentences"] += len(sentences)
+        counters["tokens"] += sum([len(sentence) for sentence in sentences])
+        return decode(self, sentences, *args, **kwargs)
+    return counted_decode
+
+WRAPPERS = [("q", _counted_q), ("e", _counted_e), ("word_row", _counted_word_row),
+            ("emission_table", _counted_emission_table), ("decode", _counted_decode)]
+
+
+class Instrumentation(object):
+    """
+    The counters, timings and profiler of one process.
+    """
+
+    def __init__(self, mode="off"):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.samples = defaultdict(int)
+        self.classes = []
+        self.originals = {}
+        self.profiler = None
+        self.mode = "off"
+        self.reported = False
+        atexit.register(self.report_at_exit)
+        self.configure(mode)
+
+    def configure(self, mode):
+        """
+        Switch to one of MODES.
+        """
+        if mode not in MODES:
+            raise InstrumentError("unknown instrumentation mode %s, expected one of %s"
+                                  % (mode, ", ".join(MODES)))
+        if self.mode == "counters":
+            for cls in self.classes:
+                self.unwrap(cls)
+        self.stop_profile()
+        self.mode = mode
+        if mode == "counters":
+            for cls in self.classes:
+                self.wrap(cls)
+        elif mode == "profile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif mode == "sample":
+            interval = float(os.environ.get("HMM_SAMPLE_INTERVAL", "0.001"))
+            signal.signal(signal.SIGPROF, self.take_sample)
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+    def register(self, cls):
+        """
+        Count the calls of the methods in WRAPPERS that cls defines.
+        """
+        self.classes.append(cls)
+        if self.mode == "counters":
+            self.wrap(cls)
+
+    def wrap(self, cls):
+        for name, wrapper in WRAPPERS:
+            if name in cls.__dict__:
+                self.originals[(cls, name)] = cls.__dict__[name]
+                setattr(cls, name, wrapper(self.counters, cls.__dict__[name]))
+
+    def unwrap(self, cls):
+        for name, wrapper in WRAPPERS:
+            if (cls, name) in self.originals:
+                setattr(cls, name, self.originals.pop((cls, name)))
+
+    def stop_profile(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.mode == "sample":
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def take_sample(self, signum, frame):
+        if frame is not None:
+            code = frame.f_code
+            self.samples["%s:%i(%s)" % (os.path.basename(code.co_filename),
+                                        code.co_firstlineno, code.co_name)] += 1
+
+    def stage(self, name):
+        """
+        Context manager timing a stage (parse, decode, write, ...).
+        """
+        if self.mode == "off":
+            return NULL_STAGE
+        return Stage(self.timings, name)
+
+    def timed(self, name, iterable):
+        """
+        iterable, with the time spent producing its items added to the
+        stage name (e.g. parsing input that is read lazily).
+        """
+        if self.mode == "off":
+            return iterable
+        return self._timed(name, iter(iterable))
+
+    def _timed(self, name, iterator):
+        timings = self.timings
+        while True:
+            start = time.time()
+            try:
+                item = iterator.next()
+            finally:
+                timings[name] += time.time() - start
+            yield item
+
+    def count(self, name, n=1):
+        if self.mode == "counters":
+            self.counters[name] += n
+
+    def snapshot(self):
+        """
+        Copies of the counters and timings, see since.
+        """
+        return dict(self.counters), dict(self.timings)
+
+    def since(self, snapshot):
+        """
+        What was counted and timed after snapshot was taken, e.g. in a
+        worker process, for merge in the parent.
+        """
+        counters, timings = snapshot
+        return (dict((name, n - counters.get(name, 0)) for name, n in self.counters.iteritems()),
+                dict((name, t - timings.get(name, 0.0)) for name, t in self.timings.iteritems()))
+
+    def merge(self, delta):
+        counters, timings = delta
+        for name, n in counters.iteritems():
+            self.counters[name] += n
+        for name, t in timings.iteritems():
+            self.timings[name] += t
+
+    def report(self, output=sys.stderr, limit=25):
+        """
+        Write the stage timings, the counters and the profile.
+        """
+        self.reported = True
+        output.write("instrumentation (%s):\n" % self.mode)
+        for name, seconds in sorted(self.timings.iteritems(), key=lambda item: -item[1]):
+            output.write("  %-16s %10.3f s\n" % (name, seconds))
+        tokens = self.counters.get("tokens", 0)
+        for name, n in sorted(self.counters.iteritems()):
+            if tokens and name not in ("sentences", "tokens"):
+                output.write("  %-16s %10i  (%.2f per token)\n" % (name, n, n / float(tokens)))
+            else:
+                output.write("  %-16s %10i\n" % (name, n))
+        if self.profiler is not None:
+            self.profiler.disable()
+            stream = StringIO()
+            stats = pstats.Stats(self.profiler, stream=stream)
+            stats.sort_stats("cumulative").print_stats(limit)
+            output.write(stream.getvalue())
+        if self.samples:
+            total = float(sum(self.samples.values()))
+            output.write("  %i samples\n" % total)
+            for name, n in sorted(self.samples.iteritems(), key=lambda item: -item[1])[:limit]:
+                output.write("  %6.2f%%  %s\n" % (100 * n / total, name))
+
+    def report_at_exit(self):
+        if self.mode != "off" and not self.reported:
+            self.stop_profile()
+            self.report()
+
+
+instrumentation = Instrumentation(os.environ.get("HMM_INSTRUMENT", "off"))
@@ -0,0 +1,362 @@
+#! /usr/bin/python
+
+import sys
+import json
+import mmap
+import struct
+import zlib
+from array import array
+from collections import defaultdict
+from word_signature import get_signature, SIGNATURES
+import smoothing
+
+"""
+Binary model file for the HMM tagger.
+
+The text counts written by Hmm.write_counts have to be parsed line by line
+on every load. A model file holds the compiled tables of an Hmm instead
+and is read through mmap: loading parses only a small header, and the
+vocabulary and probability tables stay in the page cache, shared by every
+tagger process that maps the same file.
+
+Layout (native byte order, recorded in the header):
+
+    "HMMB" | version (uint32) | header length (uint32) | JSON header
+    | sections, each starting at a multiple of 8 bytes
+
+The header holds n, the tag set, the rare-word classes and their rows,
+the signature name, the tag counts the emission rows were normalized
+with, the smoothers the tables were computed with (smoothing.py), the
+tag n-gram counts (at most a few thousand entries) and the offset/length
+of every section:
+
+    blob     bytes        all words of the vocabulary, concatenated
+    offsets  uint32[V+1]  word i is blob[offsets[i]:offsets[i+1]]
+    slots    int32[H]     open-addressing hash table of word ids (-1 empty)
+    rows     int32[V]     emission row of word i, -1 for rare words
+    counts   float64[V*K] emission counts, word i and tag k at i*K + k
+    e_table  float64[R*K] e(word | tag) per emission row
+    log_e    float64[R*K] the same in log space
+    q_table  float64[S^3] q(t | t_2, t_1) over the tags plus '*' and STOP
+"""
+
+MAGIC = "HMMB"
+VERSION = 1
+PREAMBLE = struct.Struct("=4sII")
+
+
+class ModelFileError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class MappedArray(object):
+    """
+    Read-only array of numbers inside a buffer.
+    """
+
+    def __init__(self, buf, offset, typecode, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.item = struct.Struct("=" + typecode)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.length:
+            raise IndexError("MappedArray index out of range")
+        return self.item.unpack_from(self.buf, self.offset + i * self.item.size)[0]
+
+
+class MappedRows(object):
+    """
+    Read-only rows of K doubles inside a buffer; row i is returned as a list.
+    A row is unpacked the first time it is used and kept, so tagging
+    pays for every distinct row once, not for every token.
+    """
+
+    def __init__(self, buf, offset, K, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.row = struct.Struct("=%id" % K)
+        self.rows = {}
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        row = self.rows.get(i)
+        if row is None:
+            if i < 0 or i >= self.length:
+                raise IndexError("MappedRows index out of range")
+            row = self.rows[i] = list(self.row.unpack_from(self.buf, self.offset + i * self.row.size))
+        return row
+
+
+def word_hash(word):
+    return zlib.crc32(word) & 0xffffffff
+
+
+class MappedVocab(object):
+    """
+    word -> emission row lookup over the blob/offsets/slots/rows sections.
+    Behaves like the word_ids dict of a compiled Hmm.
+    The rows of the words looked up (None for rare and unseen words)
+    are kept in a bounded cache of two generations, as in
+    word_signature.WordSignature, so a repeated word costs a dict lookup
+    instead of a hash and a probe through the mapped table.
+    """
+
+    def __init__(self, buf, blob, offsets, slots, rows, maxsize=200000):
+        self.buf = buf
+        self.blob = blob
+        self.offsets = offsets
+        self.slots = slots
+        self.rows = rows
+        self.mask = len(slots) - 1
+        self.maxsize = maxsize
+        self.recent = {}
+        self.older = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def word(self, i):
+        start = self.blob + self.offsets[i]
+        return self.buf[start:self.blob + self.offsets[i+1]]
+
+    def index(self, word):
+        """
+        Id of a word in the vocabulary, or -1.
+        """
+        slots = self.slots
+        mask = self.mask
+        h = word_hash(word) & mask
+        while True:
+            i = slots[h]
+            if i < 0 or self.word(i) == word:
+                return i
+            h = (h + 1) & mask
+
+    def lookup(self, word):
+        """
+        Emission row of a word, or None.
+        """
+        i = self.index(word)
+        if i < 0 or self.rows[i] < 0:
+            return None
+        return self.rows[i]
+
+    def get(self, word, default=None):
+        if word in self.recent:
+            row = self.recent[word]
+        else:
+            if word in self.older:
+                row = self.older[word]
+            else:
+                row = self.lookup(word)
+            if len(self.recent) * 2 >= self.maxsize:
+                self.older = self.recent
+                self.recent = {}
+            self.recent[word] = row
+        if row is None:
+            return default
+        return row
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+
+def _pad(output, position):
+    padding = -position % 8
+    output.write("\0" * padding)
+    return position + padding
+
+
+def save_model(hmm, filename):
+    """
+    Write the compiled tables and the counts of hmm to a model file.
+    """
+    if hmm.tags is None:
+        hmm.compile()
+    tags = hmm.tags
+    K = len(tags)
+    words = sorted(set(word for word, tag in hmm.emission_counts))
+    index = dict((word, i) for i, word in enumerate(words))
+
+    counts = array('d', [0.0]) * (len(words) * K)
+    for (word, tag), count in hmm.emission_counts.iteritems():
+        if tag in hmm.tag_ids:
+            counts[index[word] * K + hmm.tag_ids[tag]] = count
+    rows = array('i', [hmm.word_ids.get(word, -1) for word in words])
+
+    offsets = array('I', [0])
+    for word in words:
+        offsets.append(offsets[-1] + len(word))
+    size = 1
+    while size < 2 * len(words) + 1:
+        size *= 2
+    slots = array('i', [-1]) * size
+    for i, word in enumerate(words):
+        h = word_hash(word) & (size - 1)
+        while slots[h] >= 0:
+            h = (h + 1) & (size - 1)
+        slots[h] = i
+
+    log_e = array('d', [value for row in hmm.log_rows for value in row])
+    sections = [("blob", "".join(words)), ("offsets", offsets.tostring()),
+                ("slots", slots.tostring()), ("rows", rows.tostring()),
+                ("counts", counts.tostring()), ("e_table", array('d', hmm.e_table).tostring()),
+                ("log_e", log_e.tostring())]
+    if hmm.q_table is not None:
+        sections.append(("q_table", array('d', hmm.q_table).tostring()))
+
+    header = {
+        "byteorder": sys.byteorder,
+        "n": hmm.n,
+        "tags": tags,
+        "classes": hmm.class_rows,
+        "signature": hmm.signature.name,
+        "rare_threshold": hmm.rare_threshold,
+        "row_norms": hmm.row_norms,
+        "smoothing": [smoother and smoother.config() for smoother in
+                      (hmm.transition_smoothing, hmm.emission_smoothing)],
+        "ngrams": [[[list(ngram), count] for ngram, count in counts_n.iteritems()]
+                   for counts_n in hmm.ngram_counts],
+        "sections": {},
+    }
+    position = 0
+    for name, data in sections:
+        position += -position % 8
+        header["sections"][name] = [position, len(data)]
+        position += len(data)
+    header = json.dumps(header)
+
+    output = open(filename, "wb")
+    output.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+    output.write(header)
+    position = _pad(output, PREAMBLE.size + len(header))
+    for name, data in sections:
+        position = _pad(output, position)
+        output.write(data)
+        position += len(data)
+    output.close()
+
+
+def _str(value):
+    """
+    json returns unicode strings; the tagger works on byte strings.
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_str(v) for v in value]
+    return value
+
+
+def load_model(hmm, filename, with_counts=False):
+    """
+    Map a model file and install its tables in hmm, as compile would.
+    The emission counts are only needed to write text counts again and
+    are read into hmm.emission_counts only if with_counts is set.
+    """
+    model_file = open(filename, "rb")
+    buf = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+    model_file.close()
+    if len(buf) < PREAMBLE.size:
+        raise ModelFileError("%s is not an HMM model file" % filename)
+    magic, version, header_len = PREAMBLE.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ModelFileError("%s is not an HMM model file" % filename)
+    if version != VERSION:
+        raise ModelFileError("%s has model file version %i, expected %i" % (filename, version, VERSION))
+    header = json.loads(buf[PREAMBLE.size:PREAMBLE.size + header_len])
+    if header["byteorder"] != sys.byteorder:
+        raise ModelFileError("%s was written on a %s-endian machine" % (filename, header["byteorder"]))
+    # the class rows are only right for the signature they were built with
+    if header["signature"] not in SIGNATURES:
+        raise ModelFileError("%s has unknown word signature %s" % (filename, header["signature"]))
+    start = PREAMBLE.size + header_len
+    start += -start % 8
+    sections = dict((name, (start + offset, length))
+                    for name, (offset, length) in header["sections"].iteritems())
+
+    tags = _str(header["tags"])
+    K = len(tags)
+    states = tags + ['*', 'STOP']
+    def section(name, typecode):
+        offset, length = sections[name]
+        return MappedArray(buf, offset, typecode, length / struct.calcsize("=" + typecode))
+
+    hmm.reset_tables()
+    hmm.n = header["n"]
+    hmm.rare_threshold = header["rare_threshold"]
+    hmm.signature = get_signature(_str(header["signature"]))
+    hmm.ngram_counts = [defaultdict(int) for i in xrange(hmm.n)]
+    for i, counts_n in enumerate(header["ngrams"]):
+        for ngram, count in counts_n:
+            hmm.ngram_counts[i][tuple(_str(ngram))] = count
+    hmm.all_states = set(tags)
+    transitions, emissions = header.get("smoothing") or (None, None)
+    hmm.transition_smoothing = smoothing.from_config(transitions, smoothing.TRANSITIONS)
+    hmm.emission_smoothing = smoothing.from_config(emissions, smoothing.EMISSIONS)
+    if hmm.transition_smoothing is not None:
+        hmm.transition_smoothing.prepare(hmm.ngram_counts)
+
+    blob_offset, blob_length = sections["blob"]
+    word_ids = MappedVocab(buf, blob_offset, section("offsets", "I"),
+                           section("slots", "i"), section("rows", "i"))
+    hmm.emission_counts = defaultdict(int)
+    if with_counts:
+        counts = section("counts", "d")
+        for i in xrange(len(word_ids)):
+            word = word_ids.word(i)
+            for k in xrange(K):
+                if counts[i * K + k]:
+                    hmm.emission_counts[(word, tags[k])] = counts[i * K + k]
+
+    log_offset, log_length = sections["log_e"]
+    if "q_table" in sections:
+        hmm.q_table = section("q_table", "d")
+    hmm.tags = tags
+    hmm.tag_ids = dict((tag, i) for i, tag in enumerate(tags))
+    hmm.state_ids = dict((tag, i) for i, tag in enumerate(states))
+    hmm.word_ids = word_ids
+    hmm.class_rows = dict((_str(cls), row) for cls, row in header["classes"].iteritems())
+    hmm.e_table = section("e_table", "d")
+    hmm.log_rows = MappedRows(buf, log_offset, K, log_length / (8 * K))
+    # Files written before update existed were normalized by the tag counts
+    hmm.row_norms = header.get("row_norms") or [hmm.ngram_counts[0].get((tag,), 0) for tag in tags]
+    hmm.word_counts = None
+    hmm.raw_counts = False
+    hmm.build_transition_tables()
+
+
+def usage():
+    sys.stderr.write("""
+    Usage: python model_file.py import [counts_file] [model_file]
+        Convert counts written by count_freqs.py / Hmm.write_counts
+        into a binary model file.
+    Usage: python model_file.py export [model_file] > [counts_file]
+        Write the counts in a binary model file in the text format.\n""")
+
+if __name__ == "__main__":
+    from hmm import Hmm
+
+    if len(sys.argv) == 4 and sys.argv[1] == "import":
+        hmm = Hmm()
+        hmm.read_counts(open(sys.argv[2]))
+        save_model(hmm, sys.argv[3])
+    elif len(sys.argv) == 3 and sys.argv[1] == "export":
+        hmm = Hmm()
+        load_model(hmm, sys.argv[2], with_counts=True)
+        hmm.write_counts(sys.stdout)
+    else:
+        usage()
+        sys.exit(1)
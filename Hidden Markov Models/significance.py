@@ -0,0 +1,173 @@
+#! /usr/bin/python
+
+import random
+import string
+from itertools import compress
+from optparse import OptionParser
+
+from eval_gene_tagger import read_tagged, check_alignment, sentence_counts
+
+"""
+Is tagger B really better than tagger A, or did the F1 score move by
+chance? Both outputs are scored against the same key sentence by
+sentence, and the per-sentence true positive, false positive and false
+negative counts are resampled:
+
+    python significance.py gene.key gene_dev.a.out gene_dev.b.out
+
+- paired bootstrap: draw the sentences with replacement, score both
+  taggers on every sample and report percentile confidence intervals
+  for F1(A), F1(B) and F1(B) - F1(A), and how often the resampled
+  difference moves at least |F1(B) - F1(A)| away from the observed one.
+- approximate randomization: swap the outputs of A and B on every
+  sentence with probability 1/2 and count how often the F1 difference
+  is at least as large as the observed one.
+
+The six counts of a sentence are packed into the bit fields of one
+integer, so the counts of a whole sample are a single sum instead of six
+passes over the corpus.
+"""
+
+def f1(tp, fp, fn):
+    if tp == 0:
+        return 0.0
+    return 2.0 * tp / (2 * tp + fp + fn)
+
+
+class PairedCounts(object):
+    """
+    Per-sentence (tp, fp, fn) of tagger A and tagger B, packed.
+    """
+
+    def __init__(self, counts_a, counts_b):
+        columns = list(counts_a) + list(counts_b)
+        self.sentences = len(columns[0])
+        # A field must hold the sum of the largest count over every sentence
+        largest = max([max(column or [0]) for column in columns])
+        self.width = max(1, (largest * self.sentences).bit_length())
+        self.mask = (1 << self.width) - 1
+        self.packed = [self.pack(counts) for counts in zip(*columns)]
+        self.swapped = [self.pack(counts[3:] + counts[:3]) for counts in zip(*columns)]
+        self.total = sum(self.packed)
+
+    def pack(self, counts):
+        value = 0
+        for k, count in enumerate(counts):
+            value |= count << (k * self.width)
+        return value
+
+    def unpack(self, value):
+        return [(value >> (k * self.width)) & self.mask for k in range(6)]
+
+    def scores(self, value):
+        """
+        F1 of A and of B for a sum of packed sentence counts.
+        """
+        tp_a, fp_a, fn_a, tp_b, fp_b, fn_b = self.unpack(value)
+        return f1(tp_a, fp_a, fn_a), f1(tp_b, fp_b, fn_b)
+
+
+def bootstrap(pairs, samples=10000, rng=random):
+    """
+    Paired bootstrap: F1 of A and of B on samples resamplings of the
+    sentences, as two lists.
+    """
+    packed = pairs.packed
+    n = pairs.sentences
+    rand = rng.random
+    f1_a = []
+    f1_b = []
+    for s in xrange(samples):
+        a, b = pairs.scores(sum([packed[int(rand() * n)] for i in xrange(n)]))
+        f1_a.append(a)
+        f1_b.append(b)
+    return f1_a, f1_b
+
+
+# '0'/'1' characters to bytes 0/1, for itertools.compress
+BITS = string.maketrans("01", "\x00\x01")
+
+def randomization(pairs, samples=10000, rng=random):
+    """
+    Approximate randomization test: the p-value of the absolute F1
+    difference between A and B.
+    """
+    n = pairs.sentences
+    diffs = [swapped - packed for packed, swapped in zip(pairs.packed, pairs.swapped)]
+    a, b = pairs.scores(pairs.total)
+    observed = abs(b - a)
+    bits = "0%ib" % n
+    hits = 0
+    for s in xrange(samples):
+        # n random bits choose the sentences whose outputs are swapped
+        swaps = bytearray(format(rng.getrandbits(n), bits).translate(BITS))
+        a, b = pairs.scores(pairs.total + sum(compress(diffs, swaps)))
+        if abs(b - a) >= observed:
+            hits += 1
+    return (hits + 1.0) / (samples + 1)
+
+
+def interval(values, alpha):
+    """
+    Percentile interval holding 1 - alpha of values.
+    """
+    values = sorted(values)
+    low = int(alpha / 2 * len(values))
+    high = min(len(values) - 1, int((1 - alpha / 2) * len(values)))
+    return values[low], values[high]
+
+
+def compare_taggers(key_file, file_a, file_b, samples=10000, alpha=0.05, seed=None):
+    """
+    Run both tests on two prediction files. Returns a dict with the F1
+    scores, their confidence intervals and the p-values.
+    """
+    gs_words, gs_tags = read_tagged(key_file)
+    counts = []
+    for prediction_file in (file_a, file_b):
+        pred_words, pred_tags = read_tagged(prediction_file)
+        check_alignment(gs_words, pred_words[:len(gs_words)])
+        counts.append(sentence_counts(gs_tags, pred_tags[:len(gs_tags)]))
+    pairs = PairedCounts(*counts)
+    rng = random.Random(seed)
+
+    a, b = pairs.scores(pairs.total)
+    f1_a, f1_b = bootstrap(pairs, samples, rng)
+    deltas = [y - x for x, y in zip(f1_a, f1_b)]
+    shifted = len([d for d in deltas if abs(d - (b - a)) >= abs(b - a)])
+    return {
+        "f1_a": a, "f1_b": b, "delta": b - a,
+        "ci_a": interval(f1_a, alpha), "ci_b": interval(f1_b, alpha),
+        "ci_delta": interval(deltas, alpha),
+        "p_bootstrap": (shifted + 1.0) / (samples + 1),
+        "p_randomization": randomization(pairs, samples, rng),
+    }
+
+
+def usage():
+    return """
+    python significance.py [options] [key_file] [prediction_a] [prediction_b]
+        Test whether the F1 scores of two gene tagger outputs for the
+        sentences in key_file differ significantly."""
+
+if __name__ == "__main__":
+
+    parser = OptionParser(usage=usage())
+    parser.add_option("-n", "--samples", type="int", default=10000,
+                      help="bootstrap samples and random permutations (default 10000)")
+    parser.add_option("-a", "--alpha", type="float", default=0.05,
+                      help="confidence intervals hold 1 - alpha of the samples (default 0.05)")
+    parser.add_option("--seed", type="int", help="seed of the random number generator")
+    options, args = parser.parse_args()
+    if len(args) != 3:
+        parser.error("expecting a key file and two prediction files")
+
+    result = compare_taggers(open(args[0]), open(args[1]), open(args[2]),
+                             options.samples, options.alpha, options.seed)
+    level = "%g%% CI" % (100 * (1 - options.alpha))
+    print "\t F1-Score\t%s" % level
+    for name, key in (("A", "a"), ("B", "b"), ("B - A", "delta")):
+        low, high = result["ci_" + key]
+        print "%s:\t %f\t[%f, %f]" % (name, result[key == "delta" and "delta" or "f1_" + key], low, high)
+    print "\npaired bootstrap p = %f" % result["p_bootstrap"]
+    print "approximate randomization p = %f" % result["p_randomization"]
@@ -0,0 +1,309 @@
+#! /usr/bin/python
+
+"""
+Smoothed transition and emission estimates for the HMM tagger.
+
+The maximum likelihood estimates give probability zero to every tag
+n-gram and every (word, tag) pair missing from the training data, so the
+decoder can never choose them. The smoothers here replace them:
+
+    transitions
+      interpolate  linear interpolation of the 1-gram ... n-gram estimates,
+                   lambda_1 q(t) + lambda_2 q(t | t_1) + ... ; the weights
+                   are fit by deleted interpolation on the training counts
+                   (Brants 2000) or by EM on held-out data
+      backoff      interpolated Kneser-Ney: absolute discounting, with the
+                   mass taken off every history given to the lower order,
+                   whose estimates use continuation counts
+    emissions
+      add-lambda   (c(word, t) + lambda) / (c(t) + lambda V) over the V
+                   emission rows (frequent words and rare-word classes)
+      class        p(t | word) is drawn towards p(t | class of word) with
+                   the weight of `weight` observations, the classes
+                   towards p(t), and turned back into e(word | t)
+
+Hmm.compile computes every table cell through a smoother once, so the
+decoders read smoothed probabilities from the same tables at the same
+cost as unsmoothed ones. The settings are saved in binary model files.
+"""
+
+class SmoothingError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def observed(counts):
+    """
+    The n-grams of a count dict that predict a tag or STOP; n-grams
+    ending in '*' only pad the start of a sentence.
+    """
+    return dict((ngram, count) for ngram, count in counts.iteritems()
+                if count > 0 and ngram[-1] != '*')
+
+
+def unigrams(bigram_counts):
+    """
+    1-gram counts of every tag and STOP, from the 2-grams ending in them.
+    """
+    counts = {}
+    for ngram, count in observed(bigram_counts).iteritems():
+        counts[ngram[-1:]] = counts.get(ngram[-1:], 0) + count
+    return counts
+
+
+def history_totals(counts):
+    """
+    Sum of the counts of the n-grams sharing a history, and how many
+    distinct tags follow it.
+    """
+    totals = {}
+    types = {}
+    for ngram, count in counts.iteritems():
+        totals[ngram[:-1]] = totals.get(ngram[:-1], 0) + count
+        types[ngram[:-1]] = types.get(ngram[:-1], 0) + 1
+    return totals, types
+
+
+class Interpolation(object):
+    """
+    q(t | history) = sum over k of lambdas[k-1] * the k-gram estimate.
+    """
+
+    name = "interpolate"
+
+    def __init__(self, lambdas=None):
+        """
+        lambdas weight the 1-gram, 2-gram, ... estimates; without them the
+        weights are fit by deleted interpolation when the counts arrive.
+        """
+        self.lambdas = lambdas and [float(l) for l in lambdas]
+        self.fitted = lambdas is None
+
+    def config(self):
+        return {"name": self.name, "lambdas": self.lambdas}
+
+    def prepare(self, ngram_counts):
+        n = len(ngram_counts)
+        self.n = n
+        self.counts = [None, unigrams(ngram_counts[1])]
+        self.counts.extend([observed(ngram_counts[k-1]) for k in xrange(2, n + 1)])
+        self.totals = [None] + [history_totals(counts)[0] for counts in self.counts[1:]]
+        if self.lambdas is not None and len(self.lambdas) != n:
+            raise SmoothingError("expecting %i interpolation weights, got %i" % (n, len(self.lambdas)))
+        if self.fitted:
+            self.fit()
+
+    def estimates(self, ngram, leave_out=0):
+        """
+        The 1-gram ... len(ngram)-gram estimates of the last tag of ngram,
+        with leave_out occurrences taken out of every count.
+        """
+        values = []
+        for k in xrange(1, len(ngram) + 1):
+            suffix = ngram[-k:]
+            total = self.totals[k].get(suffix[:-1], 0) - leave_out
+            if total > 0:
+                values.append(max(self.counts[k].get(suffix, 0) - leave_out, 0) * 1.0 / total)
+            else:
+                values.append(0.0)
+        return values
+
+    def fit(self):
+        """
+        Deleted interpolation: every n-gram of the training data votes
+        with its count for the order that predicts it best once one
+        occurrence of it is left out.
+        """
+        weights = [0.0] * self.n
+        for ngram, count in self.counts[self.n].iteritems():
+            values = self.estimates(ngram, leave_out=1)
+            weights[values.index(max(values))] += count
+        self.set_lambdas(weights)
+
+    def fit_heldout(self, heldout_counts, iterations=100, tolerance=1e-6):
+        """
+        Fit the weights by EM to the n-gram counts of held-out data.
+        """
+        ngrams = [(self.estimates(ngram), count)
+                  for ngram, count in observed(heldout_counts).iteritems()]
+        lambdas = [1.0 / self.n] * self.n
+        for i in xrange(iterations):
+            weights = [0.0] * self.n
+            for values, count in ngrams:
+                mixture = sum([l * v for l, v in zip(lambdas, values)])
+                if mixture > 0:
+                    for k, (l, v) in enumerate(zip(lambdas, values)):
+                        weights[k] += count * l * v / mixture
+            old = lambdas
+            self.set_lambdas(weights)
+            lambdas = self.lambdas
+            if max([abs(a - b) for a, b in zip(old, lambdas)]) < tolerance:
+                break
+        self.fitted = False
+
+    def set_lambdas(self, weights):
+        total = sum(weights)
+        if total <= 0:
+            self.lambdas = [1.0 / len(weights)] * len(weights)
+        else:
+            self.lambdas = [w / total for w in weights]
+
+    def q(self, ngram):
+        lambdas = self.lambdas[:len(ngram)]
+        total = sum(lambdas)
+        if total <= 0:
+            return 0.0
+        return sum([l * v for l, v in zip(lambdas, self.estimates(ngram))]) / total
+
+
+class DiscountedCounts(object):
+    """
+    The counts of one order for KneserNey, with their history totals and
+    the absolute discount n1 / (n1 + 2 n2).
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.totals, self.types = history_totals(counts)
+        values = counts.values()
+        n1 = values.count(1)
+        n2 = values.count(2)
+        self.discount = n1 and n2 and n1 * 1.0 / (n1 + 2 * n2) or 0.5
+
+
+class KneserNey(object):
+    """
+    Interpolated Kneser-Ney estimates of q(t | history).
+    """
+
+    name = "backoff"
+
+    def config(self):
+        return {"name": self.name}
+
+    def prepare(self, ngram_counts):
+        n = len(ngram_counts)
+        raw = [None, unigrams(ngram_counts[1])] + \
+              [observed(ngram_counts[k-1]) for k in xrange(2, n + 1)]
+        self.raw = [None] + [DiscountedCounts(counts) for counts in raw[1:]]
+        # the lower orders count the distinct tags in front of an n-gram
+        self.continuation = [None]
+        for k in xrange(1, n):
+            counts = {}
+            for ngram in raw[k+1]:
+                counts[ngram[1:]] = counts.get(ngram[1:], 0) + 1
+            self.continuation.append(DiscountedCounts(counts))
+        self.outcomes = len(raw[1])
+
+    def estimate(self, ngram, orders):
+        order = orders[len(ngram)]
+        history = ngram[:-1]
+        total = order.totals.get(history, 0)
+        if len(ngram) == 1:
+            lower = 1.0 / self.outcomes
+        else:
+            lower = self.estimate(ngram[1:], self.continuation)
+        if total <= 0:
+            return lower
+        D = order.discount
+        return (max(order.counts.get(ngram, 0) - D, 0) + D * order.types[history] * lower) / total
+
+    def q(self, ngram):
+        return self.estimate(ngram, self.raw)
+
+
+class AddLambda(object):
+    """
+    e(word | t) = (c(word, t) + weight) / (c(t) + weight V).
+    """
+
+    name = "add-lambda"
+
+    def __init__(self, weight=0.1):
+        self.weight = weight
+
+    def config(self):
+        return {"name": self.name, "weight": self.weight}
+
+    def prepare(self, hmm, tags, tag_counts, rows):
+        self.hmm = hmm
+        self.tags = tags
+        self.norms = [count + self.weight * len(rows) for count in tag_counts]
+
+    def row(self, word):
+        counts = self.hmm.emission_counts
+        return [norm and (counts.get((word, tag), 0) + self.weight) / norm or 0.0
+                for tag, norm in zip(self.tags, self.norms)]
+
+
+class ClassBased(object):
+    """
+    e(word | t) = p(t | word) c(word) / c(t), where p(t | word) counts
+    the word's own tags plus `weight` observations spread as
+    p(t | class of word); the class distributions are smoothed the same
+    way towards p(t).
+    """
+
+    name = "class"
+
+    def __init__(self, weight=1.0):
+        self.weight = weight
+
+    def config(self):
+        return {"name": self.name, "weight": self.weight}
+
+    def posterior(self, word, prior):
+        """
+        (smoothed p(t | word) per tag, c(word)).
+        """
+        counts = [self.hmm.emission_counts.get((word, tag), 0) for tag in self.tags]
+        total = sum(counts)
+        if total + self.weight <= 0:
+            return prior, total
+        return [(c + self.weight * p) / (total + self.weight) for c, p in zip(counts, prior)], total
+
+    def prepare(self, hmm, tags, tag_counts, rows):
+        self.hmm = hmm
+        self.tags = tags
+        self.tag_counts = tag_counts
+        N = float(sum(tag_counts)) or 1.0
+        self.prior = [count / N for count in tag_counts]
+        self.classes = dict((cls, self.posterior(cls, self.prior)[0])
+                            for cls in hmm.signature.classes)
+
+    def row(self, word):
+        if word in self.classes:
+            prior = self.prior
+        else:
+            prior = self.classes.get(self.hmm.signature(word), self.prior)
+        posterior, total = self.posterior(word, prior)
+        return [count and p * total / count or 0.0
+                for p, count in zip(posterior, self.tag_counts)]
+
+
+TRANSITIONS = {
+    'interpolate': Interpolation,
+    'backoff': KneserNey,
+}
+
+EMISSIONS = {
+    'add-lambda': AddLambda,
+    'class': ClassBased,
+}
+
+
+def from_config(config, smoothers):
+    """
+    The smoother a config() dict describes, or None; smoothers is
+    TRANSITIONS or EMISSIONS.
+    """
+    if config is None:
+        return None
+    config = dict(config)
+    name = config.pop("name")
+    if name not in smoothers:
+        raise SmoothingError("unknown smoothing %s" % name)
+    return smoothers[name](**dict((str(key), value) for key, value in config.iteritems()))
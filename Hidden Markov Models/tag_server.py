@@ -0,0 +1,171 @@
+#! /usr/bin/python
+
+import sys
+import time
+import threading
+from Queue import Queue, Empty
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from optparse import OptionParser
+
+from hmm import Hmm, write_tagged
+from word_signature import get_signature, SIGNATURES
+from corpus import Corpus
+
+"""
+Serve the gene tagger over HTTP, so the model is trained or loaded once
+instead of by every consumer.
+
+POST sentences in the gene.test format (one word per line, a blank line
+after every sentence) to /tag; the response holds the tagged sentences
+in the format of gene_test.p3.out:
+
+    curl --data-binary @gene.dev http://localhost:8000/tag
+
+Requests are served by one thread each, but all decoding happens in a
+single batching thread: it waits for the first pending sentence, collects
+whatever else arrives within a short window (a few milliseconds) and tags
+everything with one predict_batch call before handing the results back.
+"""
+
+class PendingSentence(object):
+    """
+    A sentence waiting in the batch queue.
+    """
+
+    def __init__(self, sentence):
+        self.sentence = sentence
+        self.tags = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    Collects sentences from concurrent callers into batches for the tagger.
+    """
+
+    def __init__(self, hmm, window=0.005, max_batch=512):
+        if hmm.tags is None:
+            hmm.compile()
+        self.hmm = hmm
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = Queue()
+        self.batches = 0
+        self.sentences = 0
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def tag(self, sentences):
+        """
+        Tag a list of sentences; blocks until they have been decoded.
+        """
+        pending = [PendingSentence(sentence) for sentence in sentences]
+        for p in pending:
+            self.queue.put(p)
+        for p in pending:
+            p.done.wait()
+            if p.error is not None:
+                raise p.error
+        return [p.tags for p in pending]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+            try:
+                tags = self.hmm.predict_batch([p.sentence for p in batch])
+            except Exception, e:
+                for p in batch:
+                    p.error = e
+                    p.done.set()
+                continue
+            self.batches += 1
+            self.sentences += len(batch)
+            for p, Y in zip(batch, tags):
+                p.tags = Y
+                p.done.set()
+
+
+class TagHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path != "/tag":
+            self.send_error(404)
+            return
+        length = int(self.headers.getheader("content-length") or 0)
+        sentences = list(Corpus.load(StringIO(self.rfile.read(length)), tagged=False).sentences())
+        try:
+            tags = self.server.batcher.tag(sentences)
+        except Exception, e:
+            self.send_error(500, str(e))
+            return
+        output = StringIO()
+        write_tagged(output, zip(sentences, tags))
+        data = output.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # No per-request logging
+
+
+class TagServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        HTTPServer.__init__(self, address, TagHandler)
+        self.batcher = batcher
+
+
+def usage():
+    return """
+    python tag_server.py [options]
+        Serve the gene tagger on http://host:port/tag."""
+
+if __name__ == "__main__":
+
+    parser = OptionParser(usage=usage())
+    parser.add_option("-t", "--train", default="gene.train",
+                      help="tagged training file; rare words are folded into their classes")
+    parser.add_option("-m", "--model", help="binary model file to load instead of training")
+    parser.add_option("--signature", choices=sorted(SIGNATURES),
+                      help="word classes of rare words, as given to ReplaceRare.py: basic or rich (default basic)")
+    parser.add_option("--host", default="localhost")
+    parser.add_option("--port", type="int", default=8000)
+    parser.add_option("-w", "--window", type="float", default=5.0,
+                      help="milliseconds to wait for more sentences before decoding a batch")
+    parser.add_option("-b", "--max-batch", type="int", default=512,
+                      help="largest number of sentences decoded at once")
+    options, args = parser.parse_args()
+    if options.model and options.signature:
+        parser.error("a model file keeps the signature it was saved with")
+
+    hmm = Hmm(3, get_signature(options.signature or "basic"))
+    if options.model:
+        hmm.load_model(options.model)
+    else:
+        hmm.train(open(options.train))
+        hmm.replace_rare()
+
+    batcher = MicroBatcher(hmm, options.window / 1000.0, options.max_batch)
+    server = TagServer((options.host, options.port), batcher)
+    sys.stderr.write("Tagging on http://%s:%i/tag\n" % (options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
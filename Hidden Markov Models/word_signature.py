@@ -0,0 +1,121 @@
+#! /usr/bin/python
+
+"""
+Map rare words to the pseudo-word of their class (_NUM_, _ALLCAP_, ...).
+
+The same signature is used when rare words are replaced in the training
+data (ReplaceRare.py) and when the tagger looks up emissions (hmm.py), so
+both sides must agree on the classifier. The class of every word is
+computed once and kept in a bounded cache.
+"""
+
+# Useful function to judge the type of rare words
+def isNumeric(word):
+    for c in word:
+        if c.isdigit():
+            return True
+    return False
+
+def isAllCapital(word):
+    for c in word:
+        if c.islower():
+            return False
+    return True
+
+def isLastCapital(word):
+    return word[len(word)-1].isupper()
+
+
+BASIC_CLASSES = ['_NUM_', '_ALLCAP_', '_LASTCAP_', '_RARE_']
+
+def basic_class(word):
+    """
+    The four classes of the assignment.
+    """
+    if isNumeric(word):
+        return '_NUM_'
+    elif isAllCapital(word):
+        return '_ALLCAP_'
+    elif isLastCapital(word):
+        return '_LASTCAP_'
+    else:
+        return '_RARE_'
+
+
+GREEK = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'theta',
+         'kappa', 'lambda', 'sigma', 'omega']
+SUFFIXES = ['ase', 'ine', 'in', 'ing', 'ed', 'ly', 'al', 'ic', 's']
+RICH_CLASSES = ['_NUM_', '_GREEK_', '_HYPHEN_', '_ALLCAP_', '_LASTCAP_'] + \
+    ['_SUFFIX_%s_' % suffix.upper() for suffix in SUFFIXES] + ['_RARE_']
+
+def rich_class(word):
+    """
+    Finer classes for gene names: Greek letter names, hyphenated words
+    and common suffixes on top of the basic classes.
+    """
+    if isNumeric(word):
+        return '_NUM_'
+    lower = word.lower()
+    for letter in GREEK:
+        if letter in lower:
+            return '_GREEK_'
+    if '-' in word:
+        return '_HYPHEN_'
+    if isAllCapital(word):
+        return '_ALLCAP_'
+    if isLastCapital(word):
+        return '_LASTCAP_'
+    for suffix in SUFFIXES:
+        if lower.endswith(suffix):
+            return '_SUFFIX_%s_' % suffix.upper()
+    return '_RARE_'
+
+
+SIGNATURES = {
+    'basic': (basic_class, BASIC_CLASSES),
+    'rich': (rich_class, RICH_CLASSES),
+}
+
+
+class WordSignature(object):
+    """
+    Callable word -> class map with a bounded cache.
+
+    The cache keeps two generations of plain dicts. New words go into the
+    recent generation; once it holds maxsize/2 words it becomes the older
+    generation and the previous older one is dropped. A word found in the
+    older generation is moved back to the recent one, so words in use
+    survive the rotation, as in an LRU map, while a hit stays a single
+    dict lookup.
+    """
+
+    def __init__(self, classify=basic_class, classes=BASIC_CLASSES, maxsize=200000, name=None):
+        assert '_RARE_' in classes, "Expecting a _RARE_ class."
+        self.name = name
+        self.classify = classify
+        self.classes = list(classes)
+        self.maxsize = maxsize
+        self.recent = {}
+        self.older = {}
+
+    def __call__(self, word):
+        cls = self.recent.get(word)
+        if cls is None:
+            cls = self.older.get(word)
+            if cls is None:
+                cls = self.classify(word)
+            if len(self.recent) * 2 >= self.maxsize:
+                self.older = self.recent
+                self.recent = {}
+            self.recent[word] = cls
+        return cls
+
+
+def get_signature(name='basic', maxsize=200000):
+    """
+    A new WordSignature for one of the classifiers in SIGNATURES.
+    """
+    classify, classes = SIGNATURES[name]
+    return WordSignature(classify, classes, maxsize, name)
+
+default_signature = get_signature()
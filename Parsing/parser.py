@@ -4,8 +4,14 @@ __author__="Alexander Rush <srush@csail.mit.edu>"
 __date__ ="$Sep 12, 2012"
 
 import sys, json
-from collections import defaultdict
+import time
+import signal
+from array import array
+from itertools import imap
+from multiprocessing import Pool
+from optparse import OptionParser
 import math
+from eval_parser import ParseEvaluator
 
 """
 Count rule frequencies in a binarized CFG.
@@ -17,13 +23,30 @@ def sentence_iterator(copus_iterator):
 
 class CKYParser:
 
-    def __init__(self):
+    # Chart pruning of parse_log, off by default: keep the beam best
+    # symbols of every cell, and those at most threshold (in log
+    # probability) below the best; with fom they are ranked by the figure
+    # of merit of prune_cell instead of their inside probability.
+    beam = None
+    threshold = None
+    fom = False
+
+    def __init__(self, counts_file="parse_train.counts.out", wordcounts_file="wordcounts.txt",
+                 start="SBARQ"):
+        """
+        start is the root symbol of every parse; parse_log falls back to
+        other roots when a sentence has no parse from it.
+        """
+        self.start = start
         self.unary = {}
         self.binary = {}
         self.nonterm = {}
         self.wordcounts = {}
-        self.fi = open("parser_train.counts.out")
+        self.leaves = {}
+        self.fi = open(counts_file)
+        self.wordcounts_file = wordcounts_file
         self.load()
+        self.index()
 
     def load(self):
 
@@ -46,7 +69,7 @@ class CKYParser:
                 self.binary[(sym, y1, y2)] += count
 
         self.fi.close()
-        self.fi = open("wordcounts.txt")
+        self.fi = open(self.wordcounts_file)
 
         for line in self.fi:
             data = line.split()
@@ -72,6 +95,48 @@ class CKYParser:
             return 1.0 * self.binary[(sym, y1, y2)] / self.nonterm[sym]
         else:
             return 0.0
+
+    def index(self):
+        """
+        Index the binary rules by their children for parse:
+          rules[y1][y2] = [(sym, q2(sym, y1, y2), rank), ...]
+        rank is the position of the rule in self.binary; among parses of
+        equal probability parse keeps the one whose rule comes first, as
+        a scan over self.binary would. Different attachments of the same
+        phrases often have exactly the same probability, so this order,
+        and multiplying q2 * left * right as the scan did, decide which
+        parse is returned.
+        """
+        self.rules = {}
+        for rank, (sym, y1, y2) in enumerate(self.binary):
+            self.rules.setdefault(y1, {}).setdefault(y2, []).append(
+                (sym, self.q2(sym, y1, y2), rank))
+
+        # The same rules over integer symbol ids for parse_dense:
+        #   rule_list[rank] = (sym, y1, y2)
+        #   left_rules[y1]  = [(y2, sym, q2, rank), ...]
+        self.symbols = sorted(self.nonterm)
+        self.symbol_ids = dict((sym, i) for i, sym in enumerate(self.symbols))
+        ids = self.symbol_ids
+        self.rule_list = []
+        self.left_rules = [[] for sym in self.symbols]
+        for rank, (sym, y1, y2) in enumerate(self.binary):
+            self.rule_list.append((ids[sym], ids[y1], ids[y2]))
+            self.left_rules[ids[y1]].append((ids[y2], ids[sym], self.q2(sym, y1, y2), rank))
+        self.log_rules = [[(y2, sym, math.log(q), rank) for y2, sym, q, rank in rules]
+                          for rules in self.left_rules]
+        total = float(sum(self.nonterm.values()))
+        self.log_priors = [math.log(self.nonterm[sym] / total) for sym in self.symbols]
+        self.dense_leaves = {}
+
+    def leaf(self, word):
+        """
+        {sym: q1(sym, word)} over the symbols that can emit word.
+        """
+        if word not in self.leaves:
+            self.leaves[word] = dict((sym, self.q1(sym, word))
+                                     for sym in self.nonterm if self.q1(sym, word) > 0)
+        return self.leaves[word]
     
     def getJson(self, st, ed, sentence, sym, bp):
         if st == ed:
@@ -81,25 +146,227 @@ class CKYParser:
 
 
     def parse(self, sentence):
+        """
+        CKY with a sparse chart: pi[i][j] holds only the symbols with a
+        parse of words i..j, and every split combines just the rules
+        whose children are both in the two cells.
+        """
+        s_len = len(sentence)
+        pi = [[{} for x in range(s_len)] for y in range(s_len)]
+        bp = [[{} for x in range(s_len)] for y in range(s_len)]
+        for i in range(0, s_len):
+            pi[i][i] = self.leaf(sentence[i])
+
+        rules = self.rules
+        for l in range(1, s_len):
+            for i in range(0, s_len-l):
+                j = i + l
+                best = {}
+                for s in range(i, j):
+                    right = pi[s+1][j]
+                    if not right:
+                        continue
+                    for y1, left_score in pi[i][s].iteritems():
+                        by_right = rules.get(y1)
+                        if by_right is None:
+                            continue
+                        for y2, right_score in right.iteritems():
+                            for sym, rule_score, rank in by_right.get(y2, ()):
+                                score = rule_score * left_score * right_score
+                                old = best.get(sym)
+                                if old is None and score > 0 or old is not None and \
+                                        (score > old[0] or score == old[0] and rank < old[1]):
+                                    best[sym] = (score, rank, y1, y2, s)
+                for sym, (score, rank, y1, y2, s) in best.iteritems():
+                    pi[i][j][sym] = score
+                    bp[i][j][sym] = (y1, y2, s)
+
+        return self.getJson(0, s_len-1, sentence, self.start, bp)
+
+    def getDenseJson(self, st, ed, sentence, sym, back, s_len):
+        if st == ed:
+            return '["' + self.symbols[sym] + '", "' + sentence[st] + '"]'
+        entry = back[(st * s_len + ed) * len(self.symbols) + sym]
+        if entry < 0:
+            raise KeyError(self.symbols[sym])
+        rank, mid = divmod(entry, s_len)
+        x, y1, y2 = self.rule_list[rank]
+        return '["' + self.symbols[sym] + '", ' + self.getDenseJson(st, mid, sentence, y1, back, s_len) + \
+               ", " + self.getDenseJson(mid+1, ed, sentence, y2, back, s_len) + ']'
+
+    def parse_dense(self, sentence):
+        """
+        parse with a dense chart over integer symbol ids. For n words and
+        N symbols the chart is two flat arrays of n * n * N entries,
+        indexed (i * n + j) * N + sym:
+          score  the best probability of sym over words i..j (0.0: none)
+          back   rank * n + split of the rule it came from (-1: none)
+        so its size is known before parsing. active[i][j] lists the
+        symbols with a parse of words i..j, the only left children tried.
+        Returns the same parse as parse.
+        """
+        s_len = len(sentence)
+        N = len(self.symbols)
+        score = array('d', [0.0]) * (s_len * s_len * N)
+        back = array('i', [-1]) * (s_len * s_len * N)
+        active = [[None] * s_len for y in range(s_len)]
+        for i in range(0, s_len):
+            w = sentence[i]
+            if w not in self.dense_leaves:
+                self.dense_leaves[w] = [(self.symbol_ids[sym], q) for sym, q in self.leaf(w).iteritems()]
+            base = (i * s_len + i) * N
+            for sym, q in self.dense_leaves[w]:
+                score[base + sym] = q
+            active[i][i] = sorted([sym for sym, q in self.dense_leaves[w]])
+
+        left_rules = self.left_rules
+        for l in range(1, s_len):
+            for i in range(0, s_len-l):
+                j = i + l
+                base = (i * s_len + j) * N
+                for s in range(i, j):
+                    if not active[s+1][j]:
+                        continue
+                    left_base = (i * s_len + s) * N
+                    right_base = ((s+1) * s_len + j) * N
+                    for y1 in active[i][s]:
+                        left_score = score[left_base + y1]
+                        for y2, sym, rule_score, rank in left_rules[y1]:
+                            right_score = score[right_base + y2]
+                            if right_score == 0.0:
+                                continue
+                            p = rule_score * left_score * right_score
+                            k = base + sym
+                            if p > score[k] or p == score[k] and back[k] >= 0 and rank < back[k] // s_len:
+                                score[k] = p
+                                back[k] = rank * s_len + s
+                active[i][j] = [sym for sym in xrange(N) if score[base + sym] > 0.0]
+
+        root = self.symbol_ids[self.start]
+        return self.getDenseJson(0, s_len-1, sentence, root, back, s_len)
+
+    def log_chart(self, sentence):
+        """
+        The chart of parse_dense with log probabilities, which do not
+        underflow on long sentences: score is -inf where parse_dense has
+        0.0. Returns (score, back, active). Every cell but the one over
+        the whole sentence is pruned as set by beam, threshold and fom.
+        """
         s_len = len(sentence)
-        pi = [[defaultdict(float) for x in range(s_len)] for y in range(s_len)]
-        bp = [[defaultdict() for x in range(s_len)] for y in range(s_len)]
+        N = len(self.symbols)
+        neg_inf = float("-inf")
+        score = array('d', [neg_inf]) * (s_len * s_len * N)
+        back = array('i', [-1]) * (s_len * s_len * N)
+        active = [[None] * s_len for y in range(s_len)]
+        pruning = self.beam or self.threshold is not None
         for i in range(0, s_len):
             w = sentence[i]
-            for sym in self.nonterm:
-                pi[i][i][sym] = self.q1(sym, w)
+            if w not in self.dense_leaves:
+                self.dense_leaves[w] = [(self.symbol_ids[sym], q) for sym, q in self.leaf(w).iteritems()]
+            base = (i * s_len + i) * N
+            for sym, q in self.dense_leaves[w]:
+                score[base + sym] = math.log(q)
+            active[i][i] = sorted([sym for sym, q in self.dense_leaves[w]])
+            if pruning and s_len > 1:
+                active[i][i] = self.prune_cell(score, back, base, active[i][i])
 
+        left_rules = self.log_rules
         for l in range(1, s_len):
             for i in range(0, s_len-l):
                 j = i + l
-                for (sym, y1, y2), count in self.binary.iteritems():
-                        for s in range(i, j):
-                            if self.q2(sym, y1, y2) * pi[i][s][y1] * pi[s+1][j][y2] > pi[i][j][sym]:
-                                pi[i][j][sym] = self.q2(sym, y1, y2) * pi[i][s][y1] * pi[s+1][j][y2] 
-                                bp[i][j][sym] = (y1, y2, s)
-
-        print pi[0][s_len-1]['SBARQ']
-        return self.getJson(0, s_len-1, sentence, 'SBARQ', bp)
+                base = (i * s_len + j) * N
+                for s in range(i, j):
+                    if not active[s+1][j]:
+                        continue
+                    left_base = (i * s_len + s) * N
+                    right_base = ((s+1) * s_len + j) * N
+                    for y1 in active[i][s]:
+                        left_score = score[left_base + y1]
+                        for y2, sym, rule_score, rank in left_rules[y1]:
+                            p = rule_score + left_score + score[right_base + y2]
+                            if p > score[base + sym]:
+                                score[base + sym] = p
+                                back[base + sym] = rank * s_len + s
+                active[i][j] = [sym for sym in xrange(N) if back[base + sym] >= 0]
+                if pruning and l < s_len - 1:
+                    active[i][j] = self.prune_cell(score, back, base, active[i][j])
+        return score, back, active
+
+    def prune_cell(self, score, back, base, cell):
+        """
+        Drop the symbols of a cell outside the beam / threshold from the
+        chart and return the ones kept. The figure of merit adds to the
+        inside log probability of a symbol the log of its relative
+        frequency, a context-free estimate of its outside probability, so
+        that frequent symbols with a lower inside score (NP over DET) are
+        not pruned in favour of rare ones.
+        """
+        if self.fom:
+            priors = self.log_priors
+            merit = dict((sym, score[base + sym] + priors[sym]) for sym in cell)
+        else:
+            merit = dict((sym, score[base + sym]) for sym in cell)
+        ranked = sorted(cell, key=lambda sym: -merit[sym])
+        if self.beam:
+            ranked = ranked[:self.beam]
+        if self.threshold is not None and ranked:
+            best = merit[ranked[0]]
+            ranked = [sym for sym in ranked if merit[sym] >= best - self.threshold]
+        if len(ranked) == len(cell):
+            return cell
+        kept = set(ranked)
+        neg_inf = float("-inf")
+        for sym in cell:
+            if sym not in kept:
+                score[base + sym] = neg_inf
+                back[base + sym] = -1
+        return sorted(kept)
+
+    def roots(self):
+        """
+        Root symbols parse_log tries in turn: the start symbol, then S.
+        """
+        return [sym for sym in (self.start, "S") if sym in self.symbol_ids]
+
+    def flatJson(self, sentence):
+        """
+        Right-branching tree of the start symbol over the most likely
+        preterminal of every word (X if none), for sentences without a
+        parse.
+        """
+        if not sentence:
+            return "[]"
+        leaves = []
+        for w in sentence:
+            scores = self.leaf(w)
+            tag = scores and max(sorted(scores), key=scores.get) or "X"
+            leaves.append('["' + tag + '", "' + w + '"]')
+        tree = leaves[-1]
+        for leaf in reversed(leaves[:-1]):
+            tree = '["' + self.start + '", ' + leaf + ", " + tree + ']'
+        return tree
+
+    def parse_log(self, sentence):
+        """
+        Robust parse: log-space CKY that always returns a tree. The root
+        is the first of roots() with a parse of the whole sentence, else
+        the best scoring symbol over it; a sentence with no parse at all
+        gets the flat tree of flatJson.
+        """
+        s_len = len(sentence)
+        if s_len == 0:
+            return self.flatJson(sentence)
+        score, back, active = self.log_chart(sentence)
+        N = len(self.symbols)
+        top = (s_len - 1) * N
+        parsed = active[0][s_len-1]
+        for root in self.roots():
+            if self.symbol_ids[root] in parsed:
+                return self.getDenseJson(0, s_len-1, sentence, self.symbol_ids[root], back, s_len)
+        if parsed:
+            root = max(parsed, key=lambda sym: score[top + sym])
+            return self.getDenseJson(0, s_len-1, sentence, root, back, s_len)
+        return self.flatJson(sentence)
         
 
 def replaceRare():
@@ -124,13 +391,179 @@ def replaceRare():
     f.close()
 
 
+# Parser used by the parsing workers. It is set before the pool is created,
+# so forked workers share the parent's grammar instead of loading it again.
+_parser = None
+
+CHARTS = {"sparse": "parse", "dense": "parse_dense", "log": "parse_log"}
+
+
+class ParseTimeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise ParseTimeout()
+
+def _parse_job(job):
+    """
+    Parse one (index, sentence, chart, timeout) job in a worker. A
+    sentence without a parse from the start symbol is parsed again with
+    parse_log; one that takes longer than timeout seconds gets the flat
+    tree of flatJson, and so does an empty sentence (a blank input line).
+    """
+    index, sentence, chart, timeout = job
+    if not sentence:
+        return index, _parser.flatJson(sentence)
+    tree = None
+    try:
+        # the timer fires at most once; wherever that happens before it
+        # is disarmed, the ParseTimeout ends up in the handler below
+        try:
+            if timeout:
+                signal.signal(signal.SIGALRM, _alarm)
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            try:
+                tree = getattr(_parser, CHARTS[chart])(sentence)
+            except KeyError:
+                tree = _parser.parse_log(sentence)
+        finally:
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    except ParseTimeout:
+        if tree is None:
+            tree = _parser.flatJson(sentence)
+    return index, tree
+
+def parse_corpus(parser, sentences, workers=1, chart="dense", timeout=None):
+    """
+    Yield the parses of a list of sentences in order. The sentences are
+    handed out longest first, so the few long ones that dominate the
+    running time start early and do not leave the other workers idle
+    at the end.
+    """
+    global _parser
+    _parser = parser
+    order = sorted(range(len(sentences)), key=lambda i: -len(sentences[i]))
+    jobs = [(i, sentences[i], chart, timeout) for i in order]
+    pool = None
+    if workers > 1:
+        pool = Pool(workers)
+        results = pool.imap_unordered(_parse_job, jobs)
+    else:
+        results = imap(_parse_job, jobs)
+    done = {}
+    next_index = 0
+    finished = False
+    try:
+        for index, tree in results:
+            done[index] = tree
+            while next_index in done:
+                yield done.pop(next_index)
+                next_index += 1
+        finished = True
+    finally:
+        # stop the workers also when parsing failed or the caller stopped early
+        if pool is not None:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+
+def benchmark_pruning(cky, sentences, key_file, beams, thresholds):
+    """
+    Parse sentences exactly and with every beam width and threshold,
+    each with and without the figure of merit, and score the parses
+    against the trees in key_file with eval_parser.ParseEvaluator.
+    Returns (setting, sentences/sec, F1) rows.
+    """
+    key_trees = [json.loads(l) for l in key_file]
+    settings = [("exact", "dense", None, None, False), ("log", "log", None, None, False)]
+    for fom in (False, True):
+        for beam in beams:
+            settings.append(("beam=%i%s" % (beam, fom and " fom" or ""), "log", beam, None, fom))
+        for threshold in thresholds:
+            settings.append(("threshold=%g%s" % (threshold, fom and " fom" or ""), "log", None, threshold, fom))
+    rows = []
+    for name, chart, beam, threshold, fom in settings:
+        cky.beam, cky.threshold, cky.fom = beam, threshold, fom
+        start = time.time()
+        trees = list(parse_corpus(cky, sentences, 1, chart))
+        seconds = time.time() - start
+        evaluator = ParseEvaluator()
+        fscore = evaluator.compute_fscore(key_trees, [json.loads(tree) for tree in trees]).fscore()
+        rows.append((name, len(sentences) / max(seconds, 1e-9), fscore))
+    cky.beam, cky.threshold, cky.fom = None, None, False
+    return rows
+
+
+def usage():
+    return """
+    python parser.py [options] [input_file] [output_file]
+        Parse the sentences in input_file (one per line, words separated
+        by spaces) and write one tree per line in JSON to output_file.
+        Defaults: parse_test.dat and parse_test.out; use - for
+        stdin/stdout.
+        With --benchmark, parse input_file exactly and with pruning and
+        compare speed and F1, e.g.
+            python parser.py --benchmark parse_dev.key parse_dev.dat"""
+
 if __name__ == "__main__": 
-    replaceRare()
-
-    parser = CKYParser()
-    fo = open("parse_test.out", "w")
-    f = open("parse_test.dat")
-    for sentence in sentence_iterator(f):
-        print sentence
-        fo.write( parser.parse(sentence) + "\n")
+
+    parser = OptionParser(usage=usage())
+    parser.add_option("-g", "--grammar", default="parse_train.counts.out",
+                      help="rule counts written by count_cfg_freq.py")
+    parser.add_option("-w", "--workers", type="int", default=1, help="number of parsing processes")
+    parser.add_option("--timeout", type="float",
+                      help="seconds per sentence; slower sentences get a flat tree")
+    parser.add_option("--chart", choices=sorted(CHARTS), default="dense",
+                      help="sparse, dense (same parses, faster) or log (log space); "
+                           "sentences without a parse fall back to log")
+    parser.add_option("--start", default="SBARQ", help="root symbol of the parses")
+    parser.add_option("-b", "--beam", type="int",
+                      help="prune the log chart to this many symbols per cell")
+    parser.add_option("--threshold", type="float",
+                      help="prune the log chart to symbols this far (in log probability) below the cell best")
+    parser.add_option("--fom", action="store_true",
+                      help="rank the symbols of a cell for pruning by inside score plus log prior "
+                           "(needs -b or --threshold)")
+    parser.add_option("--benchmark", metavar="KEY_FILE",
+                      help="parse the input exactly and with every --beams / --thresholds setting "
+                           "and report sentences/sec and F1 against KEY_FILE")
+    parser.add_option("--beams", default="2,4,8,16", help="comma separated beams for --benchmark (default 2,4,8,16)")
+    parser.add_option("--thresholds", default="5,10", help="comma separated thresholds for --benchmark (default 5,10)")
+    parser.add_option("--replace-rare", action="store_true",
+                      help="first write parse_train_rare.dat from parse_train.dat and wordcounts.txt")
+    options, args = parser.parse_args()
+    if len(args) > 2:
+        parser.error("expecting at most an input and an output file")
+    if options.fom and not options.beam and options.threshold is None and not options.benchmark:
+        parser.error("--fom only ranks symbols for pruning; give -b or --threshold as well")
+    input_name = len(args) > 0 and args[0] or "parse_test.dat"
+    output_name = len(args) > 1 and args[1] or "parse_test.out"
+
+    if options.replace_rare:
+        replaceRare()
+    cky = CKYParser(options.grammar, start=options.start)
+    f = input_name == "-" and sys.stdin or open(input_name)
+    sentences = list(sentence_iterator(f))
+
+    if options.benchmark:
+        beams = [int(beam) for beam in options.beams.split(",") if beam]
+        thresholds = [float(threshold) for threshold in options.thresholds.split(",") if threshold]
+        print "setting\tsentences/sec\tF1"
+        for name, speed, f1 in benchmark_pruning(cky, sentences, open(options.benchmark), beams, thresholds):
+            print "%s\t%.1f\t%f" % (name, speed, f1)
+        sys.exit(0)
+
+    cky.beam, cky.threshold, cky.fom = options.beam, options.threshold, options.fom
+    if options.beam or options.threshold is not None:
+        # pruning is done in the log chart
+        options.chart = "log"
+    fo = output_name == "-" and sys.stdout or open(output_name, "w")
+    for tree in parse_corpus(cky, sentences, options.workers, options.chart, options.timeout):
+        fo.write(tree + "\n")
+    if fo is not sys.stdout:
+        fo.close()
 